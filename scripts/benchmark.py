@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright (c) 2013-2019 Jesper Öqvist <jesper@llbit.se>
+#
+# This file is part of Chunky.
+#
+# Chunky is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Chunky is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with Chunky.  If not, see <http://www.gnu.org/licenses/>.
+
+# Offline benchmark of the signing and publishing steps of shipit.py.
+#
+# The benchmark runs in a temporary directory with local stand-ins for every
+# remote service: a local FTP server, a fake Launchpad API, a bare git remote
+# for the documentation repository, and a throwaway gpg home with a fresh
+# signing key. Synthetic artifacts of the requested size are published as a
+# new version in each run, and the latency and throughput of each step is
+# reported at the end.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from os import path
+
+import shipit
+import fakeftp
+import fakelaunchpad
+
+PASSPHRASE = 'benchmark'
+
+# Writes a file of random bytes.
+def write_random(filepath, size):
+	with open(filepath, 'wb') as f:
+		while size > 0:
+			chunk = min(size, 1 << 20)
+			f.write(os.urandom(chunk))
+			size -= chunk
+
+def git(args, cwd=None):
+	with open(os.devnull, 'w') as devnull:
+		subprocess.check_call(['git'] + args, cwd=cwd, stdout=devnull, stderr=devnull)
+
+# Creates a bare docs remote with the layout of chunky-docs.
+def make_docs_remote(workdir):
+	remote = path.join(workdir, 'docs.git')
+	seed = path.join(workdir, 'docs-seed')
+	git(['init', '--bare', remote])
+	os.makedirs(path.join(seed, 'docs', 'release'))
+	open(path.join(seed, 'docs', 'release', '.keep'), 'w').close()
+	open(path.join(seed, 'version.properties'), 'w').close()
+	git(['init'], cwd=seed)
+	git(['add', '.'], cwd=seed)
+	git(['commit', '-m', 'Initial commit'], cwd=seed)
+	git(['push', remote, 'HEAD:master'], cwd=seed)
+	shutil.rmtree(seed)
+	return 'file://' + remote
+
+# Creates a gpg home with a passphrase-protected signing key.
+def make_gpg_home(workdir):
+	home = path.join(workdir, 'gnupg')
+	os.mkdir(home, 0700)
+	with open(path.join(home, 'gpg-agent.conf'), 'w') as f:
+		f.write('allow-loopback-pinentry\n')
+	os.environ['GNUPGHOME'] = home
+	with open(os.devnull, 'w') as devnull:
+		subprocess.check_call(['gpg', '--batch', '--pinentry-mode', 'loopback',
+				'--passphrase', PASSPHRASE, '--quick-gen-key',
+				'Benchmark <benchmark@localhost>', 'default', 'sign', 'never'],
+				stdout=devnull, stderr=devnull)
+	return home
+
+# Writes a core jar made of the given entries, with one entry replaced by
+# new random data, as happens when a few classes change between releases.
+def write_jar(filepath, entries, changed):
+	jar = zipfile.ZipFile(filepath, 'w', zipfile.ZIP_STORED)
+	for (i, data) in enumerate(entries):
+		if i == changed % len(entries):
+			data = os.urandom(len(data))
+		jar.writestr('se/llbit/chunky/Class%d.class' % i, data)
+	jar.close()
+
+# Creates the release notes and artifacts that shipit.py expects for a
+# version. The artifacts are hard links to the synthetic files, except the
+# core jar, which changes slightly in each version.
+def make_version(name, artifacts, jar_entries, run):
+	with open('release_notes-%s.txt' % name, 'w') as f:
+		f.write('Benchmark release %s.\n' % name)
+	with open('ChangeLog.txt', 'w') as f:
+		f.write('%s\n\n- Benchmark.\n' % name)
+	version = shipit.Version(name)
+	with open('latest.json', 'w') as f:
+		json.dump({'name': name, 'libraries': [{'name': version.jar_file()}]}, f)
+	write_jar(path.join('build', version.jar_file()), jar_entries, run)
+	for (artifact, source) in zip(version.artifacts()[1:], artifacts):
+		target = path.join('build', artifact)
+		if not path.exists(target):
+			os.link(source, target)
+	return version
+
+def total_size(filepaths):
+	return sum(path.getsize(f) for f in filepaths if path.exists(f))
+
+# Runs each step of a release and returns {step: (seconds, bytes)}.
+def run_release(version, launchpad, server_name):
+	results = {}
+	artifacts = ['build/' + artifact for artifact in version.artifacts()]
+
+	start = time.time()
+	version.sign_files()
+	results['sign_files'] = (time.time() - start, total_size(artifacts))
+
+	start = time.time()
+	(is_new, exe, dmg, zip_url, jar) = shipit.publish_launchpad(version, launchpad, server_name)
+	results['publish_launchpad'] = (time.time() - start,
+			total_size(artifacts + [a + '.sig' for a in artifacts]))
+	shipit.write_release_notes(version, exe, dmg, zip_url)
+
+	start = time.time()
+	shipit.publish_ftp(version)
+	results['publish_ftp'] = (time.time() - start, total_size(['build/ChunkyLauncher.jar',
+			'latest.json', 'build/' + version.jar_file()]))
+
+	start = time.time()
+	shipit.update_docs(version)
+	results['update_docs'] = (time.time() - start, None)
+
+	start = time.time()
+	objects = shipit.published_objects(version, server_name, 'latest.json')
+	shipit.verify_published(version, server_name, 'latest.json')
+	results['verify'] = (time.time() - start,
+			total_size([obj.local_path for obj in objects]))
+	return results
+
+def report(runs):
+	print("")
+	print("%-20s %10s %10s %10s %12s" % ('step', 'mean (s)', 'min (s)', 'max (s)', 'MiB/s'))
+	for step in ['sign_files', 'publish_launchpad', 'publish_ftp', 'update_docs', 'verify']:
+		times = [run[step][0] for run in runs]
+		size = runs[0][step][1]
+		mean = sum(times) / len(times)
+		rate = '%.2f' % (size / 1048576.0 / mean) if size else '-'
+		print("%-20s %10.3f %10.3f %10.3f %12s" % (step, mean, min(times), max(times), rate))
+
+# Backends that quick commands like -launcher should not import.
+HEAVY_MODULES = ['praw', 'launchpadlib', 'httplib', 'urllib2', 'ssl']
+
+# Imports shipit.py and prints the import time and the heavy modules loaded.
+STARTUP_PROBE = '''
+import json, sys, time
+start = time.time()
+import shipit
+print(json.dumps([time.time() - start, [m for m in %r if m in sys.modules]]))
+''' % HEAVY_MODULES
+
+# Measures how long shipit.py takes to start, both as a whole process running
+# './shipit.py -h' and as the import of the module alone.
+def startup_benchmark(runs):
+	scripts = path.dirname(path.abspath(__file__))
+	process = []
+	imports = []
+	loaded = set()
+	for i in range(runs):
+		start = time.time()
+		with open(os.devnull, 'w') as devnull:
+			subprocess.check_call([sys.executable, path.join(scripts, 'shipit.py'), '-h'],
+					stdout=devnull)
+		process.append(time.time() - start)
+		(seconds, modules) = json.loads(subprocess.check_output(
+				[sys.executable, '-c', STARTUP_PROBE], cwd=scripts))
+		imports.append(seconds)
+		loaded.update(modules)
+	print("%-20s %10s %10s %10s" % ('startup', 'mean (ms)', 'min (ms)', 'max (ms)'))
+	for (name, times) in [('shipit.py -h', process), ('import shipit', imports)]:
+		print("%-20s %10.1f %10.1f %10.1f" % (name, 1000 * sum(times) / len(times),
+				1000 * min(times), 1000 * max(times)))
+	print("Backends loaded at startup: %s" % (', '.join(sorted(loaded)) or 'none'))
+
+def usage():
+	print("usage: benchmark.py [-runs N] [-size MIB] [-keep] [-startup]")
+	print("    -runs N      number of releases to publish (default 3)")
+	print("    -size MIB    size of each synthetic artifact in MiB (default 16)")
+	print("    -keep        keep the temporary work directory")
+	print("    -startup     only measure the startup time of shipit.py")
+
+if __name__ == "__main__":
+	runs = 3
+	size = 16
+	keep = False
+	startup = False
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == '-runs' and args:
+			runs = int(args.pop(0))
+		elif arg == '-size' and args:
+			size = float(args.pop(0))
+		elif arg == '-keep':
+			keep = True
+		elif arg == '-startup':
+			startup = True
+		else:
+			usage()
+			sys.exit(0 if arg in ('-h', '--help') else 1)
+
+	if startup:
+		startup_benchmark(runs)
+		sys.exit(0)
+
+	workdir = tempfile.mkdtemp(prefix='shipit-benchmark-')
+	print("Benchmark directory: %s" % workdir)
+	os.environ['GIT_AUTHOR_NAME'] = os.environ['GIT_COMMITTER_NAME'] = 'Benchmark'
+	os.environ['GIT_AUTHOR_EMAIL'] = os.environ['GIT_COMMITTER_EMAIL'] = 'benchmark@localhost'
+	saved_cwd = os.getcwd()
+	ftp_server = None
+	lp_server = None
+	try:
+		make_gpg_home(workdir)
+		shipit.DOCS_REMOTE = make_docs_remote(workdir)
+		os.makedirs(path.join(workdir, 'site', 'chunkyupdate', 'lib'))
+		ftp_server = fakeftp.FakeFtpServer(path.join(workdir, 'site'))
+		lp_server = fakelaunchpad.FakeLaunchpadServer()
+		shipit.LP_DOWNLOAD_ROOTS['benchmark'] = lp_server.root
+		shipit.ftp_session = shipit.FtpSession('127.0.0.1', ftp_server.port)
+		shipit.credentials = shipit.Credentials(
+				shipit.PlainBackend(path.join(workdir, 'credentials.json')))
+		for (key, value) in [('gpg passphrase', PASSPHRASE), ('ftp user', 'user'),
+				('ftp password', 'password'), ('github user', 'benchmark'),
+				('github token', 'benchmark')]:
+			shipit.credentials.put(key, value)
+
+		os.chdir(workdir)
+		os.mkdir('build')
+		synthetic = []
+		for name in ['zip', 'tar', 'exe', 'dmg']:
+			synthetic.append(path.join(workdir, 'synthetic.' + name))
+			write_random(synthetic[-1], int(size * 1048576))
+		jar_entries = [os.urandom(1 << 16) for i in range(max(1, int(size * 16)))]
+		write_random('build/ChunkyLauncher.jar', 1 << 20)
+
+		results = []
+		for i in range(runs):
+			version = make_version('9.%d.0' % (i + 1), synthetic, jar_entries, i)
+			print("Run %d: publishing %s" % (i + 1, version.full))
+			results.append(run_release(version, lp_server.launchpad, 'benchmark'))
+		report(results)
+		shipit.profiler.save(path.join(workdir, 'trace.json'))
+	finally:
+		os.chdir(saved_cwd)
+		if shipit.ftp_session:
+			shipit.ftp_session.close()
+		if ftp_server:
+			ftp_server.close()
+		if lp_server:
+			lp_server.close()
+		if 'GNUPGHOME' in os.environ:
+			subprocess.call(['gpgconf', '--kill', 'gpg-agent'])
+		if not keep:
+			shutil.rmtree(workdir, ignore_errors=True)
@@ -6,7 +6,8 @@ cp private/gradle.properties ~/.gradle/
 git pull
 git checkout $RELEASE_GIT_BRANCH
 git show --oneline -s
-gpg --import private/release.key
+gpg --list-secret-keys jesper@llbit.se > /dev/null 2>&1 || \
+	gpg --import private/release.key
 
 echo "Pre-release checklist:"
 echo "    * Update release notes (& check for typos)."
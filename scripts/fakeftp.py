@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright (c) 2013-2019 Jesper Öqvist <jesper@llbit.se>
+#
+# This file is part of Chunky.
+#
+# Chunky is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Chunky is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with Chunky.  If not, see <http://www.gnu.org/licenses/>.
+
+# A minimal local FTP server serving a directory, for testing the update site
+# uploads offline. It implements the commands that ftplib uses for login,
+# CWD, passive STOR/RETR with REST, and SIZE.
+#
+# Example:
+#
+#	server = FakeFtpServer('/tmp/site')
+#	shipit.ftp_session = shipit.FtpSession('127.0.0.1', server.port)
+#	shipit.publish_ftp(version)
+#	server.close()
+
+import os
+import socket
+import SocketServer
+import threading
+from os import path
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class FakeFtpServer:
+	def __init__(self, root, user='user', password='password'):
+		self.root = path.abspath(root)
+		self.user = user
+		self.password = password
+		self.commands = []
+		self.server = ThreadingTCPServer(('127.0.0.1', 0), self.handler())
+		self.port = self.server.server_address[1]
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	# Maps an FTP path, relative to the given working directory, to a local
+	# path below the root. Returns None for paths outside the root.
+	def local_path(self, cwd, ftp_path):
+		joined = path.normpath(path.join(cwd, ftp_path))
+		if not joined.startswith('/'):
+			return None
+		return path.join(self.root, joined.lstrip('/'))
+
+	def handler(self):
+		server = self
+
+		class Handler(SocketServer.StreamRequestHandler):
+			def reply(self, line):
+				self.wfile.write(line + '\r\n')
+				self.wfile.flush()
+
+			def handle(self):
+				self.cwd = '/'
+				self.user = None
+				self.logged_in = False
+				self.rest = 0
+				self.passive = None
+				self.reply('220 Fake FTP server ready')
+				while True:
+					line = self.rfile.readline()
+					if not line:
+						break
+					line = line.rstrip('\r\n')
+					(cmd, _, arg) = line.partition(' ')
+					cmd = cmd.upper()
+					server.commands.append(cmd)
+					if cmd == 'QUIT':
+						self.reply('221 Bye')
+						break
+					method = getattr(self, 'ftp_' + cmd, None)
+					if method is None:
+						self.reply('502 Command not implemented')
+					elif not self.logged_in and cmd not in ('USER', 'PASS'):
+						self.reply('530 Not logged in')
+					else:
+						method(arg)
+				if self.passive:
+					self.passive.close()
+
+			def ftp_USER(self, arg):
+				self.user = arg
+				self.reply('331 Password required')
+
+			def ftp_PASS(self, arg):
+				if self.user == server.user and arg == server.password:
+					self.logged_in = True
+					self.reply('230 Logged in')
+				else:
+					self.reply('530 Login incorrect')
+
+			def ftp_PWD(self, arg):
+				self.reply('257 "%s"' % self.cwd)
+
+			def ftp_CWD(self, arg):
+				local = server.local_path(self.cwd, arg)
+				if local and path.isdir(local):
+					self.cwd = path.normpath(path.join(self.cwd, arg))
+					self.reply('250 OK')
+				else:
+					self.reply('550 No such directory')
+
+			def ftp_MKD(self, arg):
+				local = server.local_path(self.cwd, arg)
+				if local and not path.exists(local):
+					os.makedirs(local)
+					self.reply('257 Created')
+				else:
+					self.reply('550 Can not create directory')
+
+			def ftp_TYPE(self, arg):
+				self.reply('200 Type set')
+
+			def ftp_NOOP(self, arg):
+				self.reply('200 OK')
+
+			def ftp_SIZE(self, arg):
+				local = server.local_path(self.cwd, arg)
+				if local and path.isfile(local):
+					self.reply('213 %d' % path.getsize(local))
+				else:
+					self.reply('550 No such file')
+
+			def ftp_REST(self, arg):
+				self.rest = int(arg)
+				self.reply('350 Restarting at %d' % self.rest)
+
+			def ftp_PASV(self, arg):
+				if self.passive:
+					self.passive.close()
+				self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				self.passive.bind(('127.0.0.1', 0))
+				self.passive.listen(1)
+				port = self.passive.getsockname()[1]
+				self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port >> 8, port & 0xFF))
+
+			# Accepts the data connection opened after PASV.
+			def data_connection(self):
+				if not self.passive:
+					self.reply('425 Use PASV first')
+					return None
+				(conn, address) = self.passive.accept()
+				self.passive.close()
+				self.passive = None
+				return conn
+
+			def ftp_STOR(self, arg):
+				local = server.local_path(self.cwd, arg)
+				if not local or not path.isdir(path.dirname(local)):
+					self.reply('553 Can not store file')
+					return
+				conn = self.data_connection()
+				if not conn:
+					return
+				self.reply('150 Ok to send data')
+				with open(local, 'r+b' if self.rest and path.exists(local) else 'wb') as f:
+					f.seek(self.rest)
+					f.truncate()
+					while True:
+						data = conn.recv(1 << 16)
+						if not data:
+							break
+						f.write(data)
+				conn.close()
+				self.rest = 0
+				self.reply('226 Transfer complete')
+
+			def ftp_RETR(self, arg):
+				local = server.local_path(self.cwd, arg)
+				if not local or not path.isfile(local):
+					self.reply('550 No such file')
+					return
+				conn = self.data_connection()
+				if not conn:
+					return
+				self.reply('150 Opening data connection')
+				with open(local, 'rb') as f:
+					f.seek(self.rest)
+					while True:
+						data = f.read(1 << 16)
+						if not data:
+							break
+						conn.sendall(data)
+				conn.close()
+				self.rest = 0
+				self.reply('226 Transfer complete')
+
+		return Handler
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright (c) 2013-2019 Jesper Öqvist <jesper@llbit.se>
+#
+# This file is part of Chunky.
+#
+# Chunky is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Chunky is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with Chunky.  If not, see <http://www.gnu.org/licenses/>.
+
+# An in-process stand-in for the parts of the Launchpad API that shipit.py
+# uses, for testing the release tools offline. FakeLaunchpad mimics the
+# launchpadlib objects, and FakeLaunchpadServer accepts the add_file uploads
+# and serves the +download URLs, including the signatures, over local HTTP.
+#
+# Example:
+#
+#	server = FakeLaunchpadServer()
+#	shipit.LP_DOWNLOAD_ROOTS['fake'] = server.root
+#	shipit.publish_launchpad(version, server.launchpad, 'fake')
+#	server.close()
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import hashlib
+import shutil
+import tempfile
+import threading
+from os import path
+
+"A paginated Launchpad collection. Counts how many times it is walked."
+class FakeCollection:
+	def __init__(self):
+		self.entries = []
+		self.walks = 0
+
+	def __iter__(self):
+		self.walks += 1
+		return iter(list(self.entries))
+
+	def append(self, entry):
+		self.entries.append(entry)
+
+	def remove(self, entry):
+		self.entries.remove(entry)
+
+class FakeEntry(object):
+	def __init__(self, launchpad, link):
+		self.launchpad = launchpad
+		self.self_link = launchpad.root + link
+		launchpad.entries[self.self_link] = self
+
+	def __repr__(self):
+		return '<%s %s>' % (self.__class__.__name__, self.self_link)
+
+class FakeProject(FakeEntry):
+	def __init__(self, launchpad, name):
+		FakeEntry.__init__(self, launchpad, '/1.0/%s' % name)
+		self.name = name
+		self.releases = FakeCollection()
+		self.all_milestones = FakeCollection()
+		self.series = FakeCollection()
+
+	def newSeries(self, name, summary):
+		series = FakeSeries(self, name, summary)
+		self.series.append(series)
+		return series
+
+class FakeSeries(FakeEntry):
+	def __init__(self, project, name, summary):
+		FakeEntry.__init__(self, project.launchpad, '/1.0/%s/%s' % (project.name, name))
+		self.project = project
+		self.name = name
+		self.summary = summary
+
+	def newMilestone(self, name):
+		milestone = FakeMilestone(self, name)
+		self.project.all_milestones.append(milestone)
+		return milestone
+
+class FakeMilestone(FakeEntry):
+	def __init__(self, series, name):
+		FakeEntry.__init__(self, series.launchpad,
+				'/1.0/%s/+milestone/%s' % (series.project.name, name))
+		self.series = series
+		self.name = name
+		self.is_active = True
+
+	def createProductRelease(self, release_notes, changelog, date_released):
+		release = FakeRelease(self, release_notes, changelog, date_released)
+		self.series.project.releases.append(release)
+		return release
+
+class FakeRelease(FakeEntry):
+	def __init__(self, milestone, release_notes, changelog, date_released):
+		FakeEntry.__init__(self, milestone.launchpad, '/1.0/%s/%s/%s'
+				% (milestone.series.project.name, milestone.series.name, milestone.name))
+		self.milestone = milestone
+		self.version = milestone.name
+		self.release_notes = release_notes
+		self.changelog = changelog
+		self.date_released = date_released
+		self.files = FakeCollection()
+
+	# The path of the +download URLs of this release.
+	def download_path(self):
+		return '/%s/%s/%s/+download' % (self.milestone.series.project.name,
+				self.milestone.series.name, self.version)
+
+	def file(self, filename):
+		for f in self.files.entries:
+			if f.filename == filename:
+				return f
+		return None
+
+class FakeReleaseFile(FakeEntry):
+	def __init__(self, release, filename, content_path, signature_path):
+		FakeEntry.__init__(self, release.launchpad,
+				release.self_link[len(release.launchpad.root):] + '/+file/' + filename)
+		self.release = release
+		self.filename = filename
+		self.content_path = content_path
+		self.signature_path = signature_path
+
+	def md5(self):
+		h = hashlib.md5()
+		with open(self.content_path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 16), ''):
+				h.update(chunk)
+		return h.hexdigest()
+
+	def delete(self):
+		self.release.files.remove(self)
+		del self.launchpad.entries[self.self_link]
+
+class FakeToken:
+	def __init__(self, key, secret):
+		self.key = key
+		self.secret = secret
+
+class FakeCredentials:
+	def __init__(self):
+		self.consumer = FakeToken('Releasebot', '')
+		self.access_token = FakeToken('token', 'secret')
+
+"Stand-in for launchpadlib.launchpad.Launchpad."
+class FakeLaunchpad:
+	def __init__(self, root='http://localhost'):
+		self.root = root
+		self.entries = {}
+		self.loads = 0
+		self.credentials = FakeCredentials()
+		self.projects = {'chunky': FakeProject(self, 'chunky')}
+
+	def load(self, link):
+		self.loads += 1
+		if link not in self.entries:
+			raise KeyError(link)
+		return self.entries[link]
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+"Local HTTP server for the add_file uploads and +download URLs of a FakeLaunchpad."
+class FakeLaunchpadServer:
+	def __init__(self, launchpad=None):
+		self.storage = tempfile.mkdtemp(prefix='fakelaunchpad-')
+		self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+		self.root = 'http://127.0.0.1:%d' % self.httpd.server_port
+		if launchpad is None:
+			launchpad = FakeLaunchpad(self.root)
+		self.launchpad = launchpad
+		self.uploads = 0
+		self.lock = threading.Lock()
+		thread = threading.Thread(target=self.httpd.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def close(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+		shutil.rmtree(self.storage)
+
+	# Returns the release whose files are served under the given path.
+	def find_download(self, urlpath):
+		for entry in self.launchpad.entries.values():
+			if isinstance(entry, FakeRelease) and urlpath.startswith(entry.download_path() + '/'):
+				rest = urlpath[len(entry.download_path()) + 1:]
+				return (entry, rest)
+		return (None, None)
+
+	def add_file(self, release, form):
+		with self.lock:
+			self.uploads += 1
+			filename = form['filename'].value
+			if release.file(filename):
+				return False
+			stored = path.join(self.storage, '%d-%s' % (self.uploads, filename))
+			with open(stored, 'wb') as f:
+				shutil.copyfileobj(form['file_content'].file, f)
+			with open(stored + '.sig', 'wb') as f:
+				shutil.copyfileobj(form['signature_content'].file, f)
+			release.files.append(FakeReleaseFile(release, filename, stored, stored + '.sig'))
+			return True
+
+	def handler(self):
+		server = self
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def log_message(self, format, *args):
+				pass
+
+			def reply(self, status, body='', content_path=None):
+				self.send_response(status)
+				length = path.getsize(content_path) if content_path else len(body)
+				self.send_header('Content-Length', str(length))
+				self.end_headers()
+				if content_path:
+					with open(content_path, 'rb') as f:
+						shutil.copyfileobj(f, self.wfile, 1 << 16)
+				else:
+					self.wfile.write(body)
+
+			def do_POST(self):
+				release = server.launchpad.entries.get(server.root + self.path)
+				form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+						environ={'REQUEST_METHOD': 'POST'})
+				if not isinstance(release, FakeRelease) or form.getvalue('ws.op') != 'add_file':
+					self.reply(404, 'Not found')
+				elif not server.add_file(release, form):
+					self.reply(400, 'File already exists')
+				else:
+					self.reply(201)
+
+			def do_GET(self):
+				(release, rest) = server.find_download(self.path)
+				if release is None:
+					return self.reply(404, 'Not found')
+				parts = rest.split('/')
+				f = release.file(parts[0])
+				if f is None and parts[0].endswith('.sig') and parts[1:] == []:
+					f = release.file(parts[0][:-len('.sig')])
+					if f is None:
+						self.reply(404, 'Not found')
+					else:
+						self.reply(200, content_path=f.signature_path)
+				elif f is None:
+					self.reply(404, 'Not found')
+				elif parts[1:] == ['+md5']:
+					self.reply(200, '%s  %s\n' % (f.md5(), f.filename))
+				elif parts[1:] == []:
+					self.reply(200, content_path=f.content_path)
+				else:
+					self.reply(404, 'Not found')
+
+		return Handler
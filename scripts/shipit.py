@@ -22,54 +22,395 @@ import warnings
 
 import json
 import sys
-import praw
 import re
 import io
 import traceback
-import ftplib
 import codecs
 import os
 import shutil
 import platform
 import random, string
 import time
-from subprocess import call, Popen, PIPE
+import threading
+import tempfile
+import Queue
+import atexit
+import multiprocessing
+import contextlib
+import errno
+import fcntl
+import mmap
+import struct
+import zipfile
+import socket
+import sqlite3
+import hashlib
+import importlib
+import urlparse
+from subprocess import Popen, PIPE, STDOUT
 from getpass import getpass
 from datetime import datetime
 from string import join
 from os import path
 from shutil import copyfile
 
-import launchpadlib
-from launchpadlib.launchpad import Launchpad
+"""A module that is imported on first use. The publishing backends are only
+needed by some commands, and importing them up front made every run of the
+script pay for the HTTP, SSL and OAuth stacks."""
+class LazyModule:
+	def __init__(self, name):
+		self.name = name
+		self.module = None
+
+	def __getattr__(self, attr):
+		if self.module is None:
+			self.module = importlib.import_module(self.name)
+		return getattr(self.module, attr)
+
+praw = LazyModule('praw')
+launchpadlib = LazyModule('launchpadlib.launchpad')
+lp_uris = LazyModule('launchpadlib.uris')
+ftplib = LazyModule('ftplib')
+httplib = LazyModule('httplib')
+urllib = LazyModule('urllib')
+urllib2 = LazyModule('urllib2')
 
 # Debug logging:
 #import httplib2
 #httplib2.debuglevel = 1
 
-"Class for managing user credentials for publishing releases."
-class Credentials:
+# Maximum number of gpg processes signing artifacts at the same time.
+SIGN_WORKERS = 4
+
+# Size of the blocks used when streaming artifacts to remote servers.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Size of the blocks hashed at a time when computing checksums.
+CHECKSUM_CHUNK_SIZE = 8 << 20
+
+# Checksum manifest of the release artifacts, published with the release.
+CHECKSUMS_FILE = 'SHA256SUMS'
+
+# Checksums of previously hashed files, kept between runs.
+CHECKSUM_CACHE = path.join('build', 'checksums.json')
+
+# Directories searched for the libraries listed in latest.json.
+MANIFEST_LIB_DIRS = ['build', 'lib']
+
+# Maximum number of published files downloaded at the same time when the
+# release is verified.
+VERIFY_WORKERS = 8
+
+# Maximum number of files uploaded to Launchpad at the same time.
+LP_UPLOAD_WORKERS = 3
+
+# Update site FTP server.
+FTP_HOST = 'ftp.llbit.se'
+FTP_PORT = 21
+
+# Block size used for FTP uploads.
+FTP_BLOCK_SIZE = 1 << 16
+
+# Number of times an interrupted FTP upload is resumed before giving up.
+FTP_RETRIES = 3
+
+# Maximum number of build stages running at the same time.
+BUILD_WORKERS = multiprocessing.cpu_count()
+
+# Directory where build stage outputs are cached between builds. It is kept
+# in the mounted private directory so that it survives container restarts.
+STAGE_CACHE_DIR = path.join('private', 'stage-cache')
+
+# Maximum total size of the stage cache, in bytes.
+STAGE_CACHE_LIMIT = 4 << 30
+
+# Seconds until the local index of Launchpad releases is rebuilt.
+LP_INDEX_TTL = 24 * 60 * 60
+
+# Roots of the Launchpad download URLs by server name. Servers not listed
+# here use the web root that launchpadlib has for them.
+LP_DOWNLOAD_ROOTS = {'production': 'https://launchpad.net'}
+
+# Trace of the last run, in Chrome trace event format.
+TRACE_FILE = path.join('build', 'trace.json')
+
+# Git remote of the documentation website.
+DOCS_REMOTE = 'https://github.com/llbit/chunky-docs.git'
+
+# Number of previously published core jars that delta patches are made from.
+DELTA_HISTORY = 3
+
+# Patches larger than this fraction of the core jar are not published.
+DELTA_MAX_RATIO = 0.8
+
+# Published core jars, kept for making delta patches. One directory per
+# update site.
+PUBLISHED_JARS_DIR = path.join('private', 'published-jars')
+
+# Local checkout of the documentation website, kept between runs.
+DOCS_CHECKOUT = path.join('private', 'docs')
+
+# Seconds between polls of the git remote in watch mode.
+WATCH_INTERVAL = 60
+
+# Seconds the watched branch must be unchanged before a snapshot is built,
+# so that a burst of pushes gives one snapshot.
+WATCH_DEBOUNCE = 300
+
+# The tree and version of the last snapshot published by watch mode.
+SNAPSHOT_STATE = path.join('private', 'snapshot-state.json')
+
+# Database of the durations, sizes and upload rates of past builds.
+HISTORY_DB = path.join('private', 'history.sqlite')
+
+# Number of previous runs that the latest run is compared against.
+HISTORY_BASELINE = 5
+
+# Fraction by which a stage may be slower than its baseline before it is
+# reported as a regression.
+REGRESSION_THRESHOLD = 0.25
+
+# Directory of the git worktrees of a release matrix, one per version.
+WORKTREE_DIR = 'worktrees'
+
+# Files of the release directory that are shared with every worktree.
+WORKTREE_SHARED = ['private', 'tools', 'dist', 'build.xml', 'lpcache']
+
+# Unix socket where the release daemon accepts jobs.
+DAEMON_SOCKET = 'shipit.sock'
+
+"""Pre-recorded answers to the interactive prompts, so that a release can run
+unattended. Each prompt has a key, e.g. 'build' or 'production'; see
+PLAN_KEYS. Prompts without an answer are asked as usual, unless the plan is
+unattended, in which case they get their default answer."""
+class ReleasePlan:
+	def __init__(self, answers={}, unattended=False):
+		self.answers = dict(answers)
+		self.unattended = unattended
+
+	# Loads a JSON plan file. Plan files are unattended unless they set
+	# "unattended" to false.
+	@staticmethod
+	def load(filepath):
+		with open(filepath, 'r') as f:
+			answers = json.load(f)
+		unattended = answers.pop('unattended', True)
+		return ReleasePlan(answers, unattended)
+
+	def has(self, key):
+		return key in self.answers
+
+	def ask(self, key, prompt, default=''):
+		if key in self.answers:
+			answer = str(self.answers[key])
+		elif self.unattended:
+			answer = default
+		else:
+			return raw_input(prompt)
+		print(prompt + answer)
+		return answer
+
+# Prompt keys that can be answered by a release plan.
+PLAN_KEYS = {
+	'version': 'version to build, if not given on the command line',
+	'build': 'build the release or snapshot (y/n)',
+	'launchpad': 'publish to Launchpad (y/n)',
+	'production': 'publish to production instead of staging Launchpad (y/n)',
+	'ftp': 'publish to the update site (y/n)',
+	'reddit': 'post the release or snapshot thread (y/n)',
+	'docs': 'update the documentation (y/n)',
+	'push': 'push the release commit and tag (y/n)',
+	'retry': 'retry failed signing or logins (y/n)',
+	'upload_fix': 'after failed Launchpad uploads: r(etry) or m(anual)',
+	'delete_tag': 'delete an existing snapshot tag and try again (y/n)',
+}
+
+plan = ReleasePlan()
+
+# Asks a question, or takes the answer from the release plan.
+def ask(key, prompt, default=''):
+	return plan.ask(key, prompt, default)
+
+"""Runs a function in a background thread. result() waits for the function
+to finish, then returns its value or raises its exception."""
+class Future:
+	def __init__(self, func, *args):
+		self.value = None
+		self.error = None
+		self.thread = threading.Thread(target=self.run, args=(func,) + args)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self, func, *args):
+		try:
+			self.value = func(*args)
+		except:
+			self.error = sys.exc_info()
+
+	def result(self):
+		self.thread.join()
+		if self.error:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.value
+
+"""Records a trace of the release in the Chrome trace event format (open it
+in chrome://tracing): build stages, uploads, and every external command
+together with its resource usage."""
+class Profiler:
+	def __init__(self):
+		self.events = []
+		self.threads = {}
+		self.lock = threading.Lock()
+		self.start = time.time()
+
+	def record(self, name, cat, start, end, args):
+		with self.lock:
+			tid = self.threads.setdefault(threading.current_thread().ident,
+					len(self.threads) + 1)
+			self.events.append({
+				'name': name,
+				'cat': cat,
+				'ph': 'X',
+				'pid': os.getpid(),
+				'tid': tid,
+				'ts': int((start - self.start) * 1e6),
+				'dur': int((end - start) * 1e6),
+				'args': args,
+			})
+
+	# Records the wall time of the body of a with statement. The yielded
+	# dictionary is stored as the arguments of the trace event.
+	@contextlib.contextmanager
+	def span(self, name, cat, **args):
+		start = time.time()
+		try:
+			yield args
+		finally:
+			self.record(name, cat, start, time.time(), args)
+
+	def save(self, filepath=TRACE_FILE):
+		if not self.events or not path.isdir(path.dirname(filepath)):
+			return
+		with self.lock:
+			tmp = filepath + '.tmp'
+			with open(tmp, 'w') as f:
+				json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+			os.rename(tmp, filepath)
+
+profiler = Profiler()
+
+# Runs a command and returns (returncode, output), where output is the
+# captured standard output if stdout is PIPE. The wall time, child CPU time,
+# peak RSS and block I/O of the command are recorded in the trace. Command
+# arguments are not recorded since they may contain tokens.
+def traced_call(command, input=None, stdout=None, stderr=None, name=None, cwd=None):
+	if name is None:
+		name = path.basename(command[0])
+		if len(command) > 1 and not command[1].startswith('-'):
+			name += ' ' + path.basename(command[1])
+	start = time.time()
+	proc = Popen(command, stdin=PIPE if input is not None else None,
+			stdout=stdout, stderr=stderr, cwd=cwd)
+	if input is not None:
+		try:
+			proc.stdin.write(input)
+		except IOError:
+			pass # The command exited without reading its input.
+		proc.stdin.close()
+	output = proc.stdout.read() if stdout == PIPE else None
+	while True:
+		try:
+			(pid, status, usage) = os.wait4(proc.pid, 0)
+			break
+		except OSError as e:
+			if e.errno != errno.EINTR:
+				raise
+	if os.WIFSIGNALED(status):
+		proc.returncode = -os.WTERMSIG(status)
+	else:
+		proc.returncode = os.WEXITSTATUS(status)
+	profiler.record(name, 'command', start, time.time(), {
+		'returncode': proc.returncode,
+		'cpu_user_s': usage.ru_utime,
+		'cpu_sys_s': usage.ru_stime,
+		'max_rss_kb': usage.ru_maxrss,
+		'io_read_bytes': usage.ru_inblock * 512,
+		'io_write_bytes': usage.ru_oublock * 512,
+	})
+	return (proc.returncode, output)
+
+"Credential backend that keeps the credentials in a gpg-encrypted JSON file."
+class GpgBackend:
+	def __init__(self, filepath, recipient='jesper@llbit.se'):
+		self.path = path.abspath(filepath)
+		self.recipient = recipient
+
+	def load(self):
+		if not path.exists(self.path):
+			return {}
+		return json.loads(traced_call(['gpg', '--decrypt', self.path], stdout=PIPE)[1])
+
+	def store(self, credentials):
+		# The release key is imported into a fresh keyring in the container,
+		# so its owner trust is unknown; --batch would refuse to use it.
+		(returncode, output) = traced_call(['gpg', '--batch', '--yes',
+				'--trust-model', 'always', '--output', self.path,
+				'-r', self.recipient, '--encrypt'], input=json.dumps(credentials))
+		return returncode == 0
+
+"Credential backend that keeps the credentials in a plain JSON file, for testing."
+class PlainBackend:
 	def __init__(self, filepath):
+		self.path = path.abspath(filepath)
+
+	def load(self):
+		if not path.exists(self.path):
+			return {}
+		with open(self.path, 'r') as f:
+			return json.load(f)
+
+	def store(self, credentials):
+		with open(self.path, 'w') as f:
+			json.dump(credentials, f)
+		return True
+
+"Credential backend that reads the credentials from a stream, for child processes."
+class PipeBackend:
+	def __init__(self, stream):
+		self.stream = stream
+
+	def load(self):
+		data = self.stream.read()
+		return json.loads(data) if data.strip() else {}
+
+	# The parent process owns the credential store, so changes are dropped.
+	def store(self, credentials):
+		return True
+
+"""Class for managing user credentials for publishing releases. The backend is
+read once, and changes are only kept in memory until flush() is called."""
+class Credentials:
+	def __init__(self, backend):
 		self.initialized = False
+		self.dirty = False
 		self.credentials = {}
-		self.path = path.abspath(filepath)
+		self.backend = backend
+		# Serializes prompts from concurrent publish steps.
+		self.lock = threading.RLock()
 
 	def init(self):
-		if not self.initialized and path.exists(self.path):
-			proc = Popen(['gpg', '--decrypt', self.path], stdout=PIPE)
-			creds = proc.communicate()[0]
-			self.credentials = json.loads(creds)
+		if not self.initialized:
+			self.credentials = self.backend.load()
 		self.initialized = True
 
-
 	# Check if the key has a value in the credential store, otherwise
 	# ask for user input.
 	def get(self, key):
-		self.init()
-		if key not in self.credentials:
-			self.credentials[key] = raw_input(key+': ')
-			self.save()
-		return self.credentials[key]
+		with self.lock:
+			self.init()
+			if key not in self.credentials:
+				self.put(key, raw_input(key+': '))
+			return self.credentials[key]
 
 	def get_noninteractive(self, key):
 		self.init()
@@ -78,32 +419,106 @@ class Credentials:
 		return self.credentials[key]
 
 	def getpass(self, key):
-		self.init()
-		if key not in self.credentials:
-			self.credentials[key] = getpass(prompt=key+': ')
-			self.save()
-		return self.credentials[key]
+		with self.lock:
+			self.init()
+			if key not in self.credentials:
+				self.put(key, getpass(prompt=key+': '))
+			return self.credentials[key]
 
 	def put(self, key, value):
 		self.init()
-		self.credentials[key] = value
-		self.save()
+		if self.credentials.get(key) != value:
+			self.credentials[key] = value
+			self.dirty = True
 
 	def remove(self, key):
-		del self.credentials[key]
-		self.save()
-
-	def save(self):
-		proc = Popen('gpg --output credentials.gpg -r jesper@llbit.se --encrypt'.split(), stdin=PIPE)
-		proc.communicate(json.dumps(self.credentials))
-		if proc.returncode is not 0:
+		self.init()
+		if key in self.credentials:
+			del self.credentials[key]
+			self.dirty = True
+
+	# Writes the credentials to the backend if they have changed.
+	def flush(self):
+		if not self.dirty:
+			return
+		if self.backend.store(self.credentials):
+			self.dirty = False
+		else:
 			print("Warning: failed to encrypt credentials!")
 
+"""Index of the version sections in a ChangeLog. The file is scanned once,
+recording where the text of each version starts and ends; sections are
+then read directly from their offsets.
+
+Each section starts with a line holding the version, followed by the change
+lines up to the next blank line. The first line of the file always starts a
+section."""
+class ChangeLog:
+	def __init__(self, filepath='ChangeLog.txt'):
+		self.path = filepath
+		self.sections = [] # (version, offset, length), in file order.
+		self.index = {}
+		self.scan()
+
+	def scan(self):
+		with open(self.path, 'rb') as f:
+			offset = 0
+			current = None
+			for line in f:
+				stripped = line.strip()
+				words = stripped.split()
+				header = words and not line[0].isspace() and Version.regex.match(words[0].rstrip(':'))
+				if current is None or header:
+					if current:
+						self.add(current)
+					name = words[0].rstrip(':') if words else ''
+					current = [name, None, None, False]
+				elif not current[3]:
+					if stripped:
+						if current[1] is None:
+							current[1] = offset
+						current[2] = offset + len(line)
+					elif current[1] is not None:
+						current[3] = True # A blank line ends the section.
+				offset += len(line)
+			if current:
+				self.add(current)
+
+	def add(self, section):
+		(name, start, end, done) = section
+		if start is None:
+			start = end = 0
+		self.sections.append((name, start, end - start))
+		self.index.setdefault(name, self.sections[-1])
+
+	def versions(self):
+		names = []
+		for (name, start, length) in self.sections:
+			if Version.regex.match(name) and name not in names:
+				names.append(name)
+		return names
+
+	# Returns the change lines for a version, or None if it has no section.
+	def section(self, version):
+		if version not in self.index:
+			return None
+		return self.read(self.index[version])
+
+	def first(self):
+		return self.read(self.sections[0]) if self.sections else ''
+
+	def read(self, section):
+		(name, start, length) = section
+		with open(self.path, 'rb') as f:
+			f.seek(start)
+			text = f.read(length).decode('utf-8')
+		return join([line.rstrip() + '\n' for line in text.splitlines()], '')
+
 "Contains description of a relase version, including release notes and updatesite"
 class Version:
 	regex = re.compile('^(\d+\.\d+(\.\d+)?)(-[a-zA-Z]*\.?\d*)?$')
 
-	def __init__(self, version):
+	def __init__(self, version, load=True):
 		self.full = version
 		r = self.regex.match(version)
 		if not r:
@@ -113,6 +528,14 @@ class Version:
 		self.milestone = r.groups()[0]
 		self.suffix = r.groups()[2]
 		self.series = join(self.milestone.split('.')[:2], '.')
+		self.changelog = ""
+		self.release_notes = ""
+		self.notes_file = None
+		if load:
+			self.load_release_notes()
+			self.load_changelog()
+
+	def load_release_notes(self):
 		notes_fn = 'release_notes-%s.txt' % self.milestone
 		notes_fn2 = 'release_notes-%s.txt' % self.full
 		if not path.exists(notes_fn):
@@ -133,24 +556,17 @@ class Version:
 			print("Error: failed to read release notes!")
 			sys.exit(1)
 
-		self.changelog = ""
 		self.release_notes = ""
 		self.notes_file = notes_fn
 
+	# Uses the ChangeLog section of this version, or the first section if
+	# the version has none yet.
+	def load_changelog(self, changelog=None):
 		try:
-			# Load changelog.
-			with codecs.open("ChangeLog.txt", 'r', encoding='utf-8') as f:
-				f.readline() # Skip version line.
-				first = True
-				while True:
-					line = f.readline().rstrip()
-					if not line:
-						if first:
-							continue
-						else:
-							break
-					self.changelog += line + '\n'
-					first = False
+			if changelog is None:
+				changelog = ChangeLog("ChangeLog.txt")
+			self.changelog = changelog.section(self.full) \
+				or changelog.section(self.milestone) or changelog.first()
 		except:
 			print("Error: could not read ChangeLog!")
 			sys.exit(1)
@@ -174,30 +590,103 @@ class Version:
 	def dmg_file(self):
 		return 'Chunky-%s.dmg' % self.full
 
-	def sign_files(self):
-		sign_file(self.jar_file())
-		sign_file(self.zip_file())
-		sign_file(self.tar_file())
-		sign_file(self.exe_file())
-		sign_file(self.dmg_file())
+	# All release artifacts, in upload order.
+	def artifacts(self):
+		return [self.jar_file(), self.zip_file(), self.tar_file(),
+				self.exe_file(), self.dmg_file()]
 
-def sign_file(filename):
+	# Writes the checksum manifest, then signs it with the artifacts.
+	def sign_files(self):
+		write_checksums(self.artifacts())
+		sign_files(self.artifacts() + [CHECKSUMS_FILE])
+
+# Runs func on each item using at most the given number of worker threads.
+# Returns a list of (item, result, error) tuples in the same order as items,
+# where error is the sys.exc_info() triple of a failed call, or None.
+def parallel_map(func, items, workers):
+	items = list(items)
+	results = [None] * len(items)
+	queue = Queue.Queue()
+	for i in range(len(items)):
+		queue.put(i)
+	def worker():
+		while True:
+			try:
+				i = queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				results[i] = (items[i], func(items[i]), None)
+			except:
+				results[i] = (items[i], None, sys.exc_info())
+	threads = [threading.Thread(target=worker)
+			for _ in range(max(1, min(workers, len(items))))]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+# Unlocks the signing key in gpg-agent by signing a throwaway file. After
+# this the agent has the passphrase cached, so the parallel signing processes
+# do not each need to unlock the key.
+def unlock_signing_key():
 	while True:
 		passphrase = credentials.getpass('gpg passphrase')
-		print("Signing build/" + filename)
-		proc = Popen(['gpg',
-				'--pinentry-mode', 'loopback',
-				'--passphrase-fd', '0',
-				'--detach-sig', 'build/' + filename], stdin=PIPE)
-		proc.communicate(passphrase + "\n")
-		if proc.returncode is not 0:
-			credentials.remove('gpg passphrase')
+		fd, probe = tempfile.mkstemp(prefix='shipit-unlock-')
+		os.close(fd)
+		try:
+			(returncode, output) = traced_call(['gpg', '--batch', '--yes',
+					'--pinentry-mode', 'loopback',
+					'--passphrase-fd', '0',
+					'--output', os.devnull,
+					'--detach-sig', probe], input=passphrase + "\n", name='gpg unlock')
+		finally:
+			os.remove(probe)
+		if returncode == 0:
+			return passphrase
+		credentials.remove('gpg passphrase')
+		print("Failed to unlock signing key.")
+		if ask('retry', 'Retry? [y/N] ') != 'y':
+			sys.exit(1)
+
+# Creates build/<filename>.sig. Returns True on success.
+def gpg_sign(filename, passphrase):
+	print("Signing build/" + filename)
+	(returncode, output) = traced_call(['gpg', '--batch', '--yes',
+			'--pinentry-mode', 'loopback',
+			'--passphrase-fd', '0',
+			'--detach-sig', 'build/' + filename],
+			input=passphrase + "\n", name='gpg sign ' + filename)
+	return returncode == 0
+
+# Checks build/<filename>.sig against build/<filename>. Returns True if valid.
+def gpg_verify(filename):
+	with open(os.devnull, 'w') as devnull:
+		return traced_call(['gpg', '--batch', '--verify',
+				'build/' + filename + '.sig', 'build/' + filename],
+				stdout=devnull, stderr=devnull, name='gpg verify ' + filename)[0] == 0
+
+# Signs all given build artifacts concurrently, then verifies every signature
+# in one pass. Only the artifacts that failed are signed again on retry.
+def sign_files(filenames):
+	pending = list(filenames)
+	while pending:
+		passphrase = unlock_signing_key()
+		signed = parallel_map(lambda fn: gpg_sign(fn, passphrase), pending, SIGN_WORKERS)
+		failed = [fn for (fn, ok, error) in signed if not ok]
+		verified = parallel_map(gpg_verify,
+				[fn for fn in pending if fn not in failed], SIGN_WORKERS)
+		failed += [fn for (fn, ok, error) in verified if not ok]
+		if not failed:
+			break
+		for filename in failed:
 			print("Failed to sign file: " + filename)
-			if raw_input('Retry? [y/N] ') == 'y':
-				continue
-			else:
-				sys.exit(1)
-		break
+		if ask('retry', 'Retry? [y/N] ') == 'y':
+			pending = [fn for fn in pending if fn in failed]
+			continue
+		sys.exit(1)
 
 # The following class is from https://stackoverflow.com/a/24176022/1250278
 class cd:
@@ -212,69 +701,646 @@ class cd:
 	def __exit__(self, etype, value, traceback):
 		os.chdir(self.savedPath)
 
-# Runs a command and aborts build if it failed.
-def check_call(description, command):
-	if call(command) != 0:
+# Runs a command and aborts build if it failed. The command output is
+# written to the log file, if one is given. Commands that run while other
+# steps are running must use cwd instead of changing directory, since the
+# working directory is shared by the whole process.
+def check_call(description, command, log=None, cwd=None):
+	if traced_call(command, stdout=log, stderr=STDOUT if log else None,
+			name=description, cwd=cwd)[0] != 0:
 		print("Error: %s failed! Aborting build." % description)
 		sys.exit(1)
 
-def build_release(version):
+# Returns a digest of a file, or of all files and symlinks below a directory.
+def path_digest(filepath):
+	if not path.isdir(filepath):
+		return file_digest(filepath)
+	h = hashlib.sha256()
+	for (root, dirs, files) in os.walk(filepath):
+		dirs.sort()
+		for name in sorted(files + [d for d in dirs if path.islink(path.join(root, d))]):
+			full = path.join(root, name)
+			h.update(path.relpath(full, filepath) + '\0')
+			if path.islink(full):
+				h.update('link:' + os.readlink(full) + '\0')
+			else:
+				h.update(file_digest(full) + '\0')
+	return h.hexdigest()
+
+# Copies a file or directory tree, replacing whatever is at the destination.
+def copy_path(src, dst):
+	if path.islink(dst) or path.isfile(dst):
+		os.remove(dst)
+	elif path.isdir(dst):
+		shutil.rmtree(dst)
+	parent = path.dirname(dst)
+	if parent and not path.exists(parent):
+		os.makedirs(parent)
+	if path.isdir(src):
+		shutil.copytree(src, dst, symlinks=True)
+	else:
+		shutil.copy2(src, dst)
+
+# Holds an exclusive lock on a lock file, for state that is shared by the
+# concurrent targets of a release matrix.
+@contextlib.contextmanager
+def file_lock(filepath):
+	with open(filepath, 'a') as f:
+		fcntl.flock(f, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(f, fcntl.LOCK_UN)
+
+# Returns the tree hash of the checked out commit, or None if tracked files
+# have uncommitted changes.
+def git_tree_state():
+	(returncode, status) = traced_call(
+			['git', 'status', '--porcelain', '--untracked-files=no'], stdout=PIPE)
+	if status.strip() or returncode != 0:
+		return None
+	(returncode, tree) = traced_call(['git', 'rev-parse', 'HEAD^{tree}'], stdout=PIPE)
+	return tree.strip() if returncode == 0 else None
+
+"""Cache of stage outputs, keyed by a hash of the stage inputs. The least
+recently used entries are evicted when the cache grows beyond its limit."""
+class StageCache:
+	def __init__(self, root=STAGE_CACHE_DIR, limit=STAGE_CACHE_LIMIT):
+		self.root = root
+		self.limit = limit
+		self.lock = threading.Lock()
+
+	# Copies the cached outputs back into place. Returns False on a miss.
+	def restore(self, key, outputs, optional=[]):
+		entry = path.join(self.root, key)
+		with self.lock:
+			if not path.isdir(entry):
+				return False
+			for output in outputs:
+				copy_path(path.join(entry, output), output)
+			for output in optional:
+				if path.lexists(path.join(entry, output)):
+					copy_path(path.join(entry, output), output)
+			os.utime(entry, None)
+		return True
+
+	def store(self, key, outputs, optional=[]):
+		entry = path.join(self.root, key)
+		if not path.isdir(self.root):
+			os.makedirs(self.root)
+		with self.lock, file_lock(self.root + '.lock'):
+			tmp = entry + '.tmp'
+			if path.exists(tmp):
+				shutil.rmtree(tmp)
+			for output in outputs + [o for o in optional if path.lexists(o)]:
+				copy_path(output, path.join(tmp, output))
+			if path.exists(entry):
+				shutil.rmtree(entry)
+			os.rename(tmp, entry)
+			self.evict()
+
+	# Removes the least recently used entries until the cache fits the limit.
+	def evict(self):
+		entries = []
+		for name in os.listdir(self.root):
+			entry = path.join(self.root, name)
+			size = 0
+			for (root, dirs, files) in os.walk(entry):
+				size += sum(path.getsize(path.join(root, f)) for f in files
+						if not path.islink(path.join(root, f)))
+			entries.append((path.getmtime(entry), size, entry))
+		entries.sort(reverse=True)
+		total = 0
+		for (mtime, size, entry) in entries:
+			total += size
+			if total > self.limit:
+				print("Evicting %s from stage cache" % path.basename(entry))
+				shutil.rmtree(entry)
+
+"""A build step in the release build graph. The run function is called with
+the log file of the stage. Inputs and outputs are file paths; outputs must
+exist when the stage has finished, optional outputs are cached if they do.
+The salt lists extra values that the outputs depend on; a None in the salt
+or the inputs makes the stage uncacheable."""
+class Stage:
+	def __init__(self, name, run, deps=[], inputs=[], outputs=[], salt=[],
+			optional_outputs=[]):
+		self.name = name
+		self.run = run
+		self.deps = deps
+		self.inputs = inputs
+		self.outputs = outputs
+		self.optional_outputs = optional_outputs
+		self.salt = salt
+		self.key = None
+
+	# Computes the cache key from the salt, the input files and the keys of
+	# the stages this stage depends on. Returns None if not cacheable.
+	def cache_key(self, dep_keys):
+		if None in self.salt or None in self.inputs or None in dep_keys:
+			return None
+		h = hashlib.sha256()
+		for value in [self.name] + self.salt + dep_keys:
+			h.update(value + '\0')
+		for filepath in self.inputs:
+			if not path.exists(filepath):
+				return None
+			h.update(filepath + '\0' + path_digest(filepath) + '\0')
+		return h.hexdigest()
+
+	def log_path(self):
+		return 'build/logs/%s.log' % self.name
+
+	# Runs the stage, or restores its outputs from the cache, and returns
+	# True if it succeeded.
+	def execute(self, cache=None, dep_keys=[]):
+		if not path.exists('build/logs'):
+			os.makedirs('build/logs')
+		with profiler.span(self.name, 'stage') as trace_args:
+			if cache:
+				self.key = self.cache_key(dep_keys)
+				if self.key and cache.restore(self.key, self.outputs, self.optional_outputs):
+					print("Restored stage %s from cache" % self.name)
+					trace_args['cached'] = True
+					return True
+			print("Starting stage %s" % self.name)
+			start = time.time()
+			try:
+				with open(self.log_path(), 'w') as log:
+					self.run(log)
+			except SystemExit:
+				return False
+			except:
+				with open(self.log_path(), 'a') as log:
+					traceback.print_exc(file=log)
+				return False
+			missing = [output for output in self.outputs if not path.exists(output)]
+			if missing:
+				print("Error: stage %s did not produce %s" % (self.name, join(missing, ', ')))
+				return False
+			print("Finished stage %s (%.1f s)" % (self.name, time.time() - start))
+			if cache and self.key:
+				cache.store(self.key, self.outputs, self.optional_outputs)
+			return True
+
+# Runs build stages in dependency order, with independent stages running at
+# the same time. If a stage fails, no further stages are started and the
+# build is aborted once the running stages have finished. Stage outputs are
+# restored from the cache instead of rebuilt when their inputs are unchanged.
+def run_stages(stages, workers=BUILD_WORKERS, cache=None):
+	by_name = dict((stage.name, stage) for stage in stages)
+	pending = list(stages)
+	done = set()
+	failed = []
+	completed = Queue.Queue()
+	running = 0
+	while pending or running:
+		if not failed:
+			for stage in [s for s in pending if all(d in done for d in s.deps)]:
+				if running >= workers:
+					break
+				pending.remove(stage)
+				dep_keys = [by_name[dep].key for dep in stage.deps]
+				thread = threading.Thread(target=lambda stage=stage, dep_keys=dep_keys:
+						completed.put((stage, stage.execute(cache, dep_keys))))
+				thread.daemon = True
+				thread.start()
+				running += 1
+		if not running:
+			break
+		(stage, ok) = completed.get()
+		running -= 1
+		if ok:
+			done.add(stage.name)
+		else:
+			failed.append(stage)
+	for stage in failed:
+		print("Error: stage %s failed! See %s" % (stage.name, stage.log_path()))
+	if failed or pending:
+		print("Aborting build.")
+		sys.exit(1)
+
+# https://stackoverflow.com/a/7553878/1250278
+# The background, Finder layout and volume icon are grafted into the image
+# straight from dist/ instead of being copied into dmgdir first.
+def build_dmg(version, log):
+	os.symlink('/Applications', 'dmgdir/Applications')
+	check_call('DMG build',
+			'genisoimage -V Chunky -D -R -apple -no-pad -graft-points -o'.split() \
+			+ ['build/' + version.dmg_file(),
+				'.background/background.png=dist/chunky-dmg.png',
+				'.DS_Store=dist/DS_Store',
+				'.Volume.icns=dist/Chunky.icns',
+				'dmgdir'], log)
+	shutil.rmtree('dmgdir') # Cleanup.
+
+# The stages of a release build. The Windows installer and the Mac bundle
+# only depend on the Gradle build, so they are built in parallel.
+def release_stages(version):
+	app_jar = 'build/chunky-%s.jar' % version.full
+	salt = [version.full]
+	return [
+		Stage('gradle',
+			lambda log: check_call('Gradle build',
+				['./gradlew', '--rerun-tasks', '-PnewVersion=' + version.full,
+				'tarball', 'releaseJar', 'releaseZip', 'documentation', 'release'], log),
+			# Release notes are not in the git tree, so they are an input.
+			inputs=[version.notes_file],
+			outputs=['build/' + version.jar_file(), 'build/' + version.tar_file(),
+				'build/' + version.zip_file(), app_jar, 'build/ChunkyLauncher.jar',
+				'build/ReadMe.html', 'build/release_notes-%s.txt' % version.full],
+			optional_outputs=['latest.json'],
+			salt=salt + [git_tree_state()]),
+		Stage('ant-nsi',
+			lambda log: check_call('Ant build',
+				['ant', '-Dversion=' + version.full, 'nsi'], log),
+			deps=['gradle'],
+			inputs=['build.xml', 'dist/Chunky.nsi'],
+			outputs=['Chunky.nsi'],
+			salt=salt),
+		Stage('ant-macapp',
+			lambda log: check_call('Ant build',
+				['ant', '-Dversion=' + version.full, 'macApp'], log),
+			deps=['gradle'],
+			inputs=['build.xml', 'dist/Chunky.icns', 'tools/appbundler-1.0ea.jar', app_jar],
+			outputs=['dmgdir/Chunky.app'],
+			salt=salt),
+		Stage('nsis',
+			lambda log: check_call('NSIS', nsis(['Chunky.nsi']), log),
+			deps=['ant-nsi'],
+			inputs=['Chunky.nsi', app_jar, 'build/ReadMe.html',
+				'build/release_notes-%s.txt' % version.full, 'dist/chunky.ico'],
+			outputs=['build/' + version.exe_file()],
+			salt=salt),
+		Stage('dmg',
+			lambda log: build_dmg(version, log),
+			deps=['ant-macapp'],
+			inputs=['dmgdir/Chunky.app', 'dist/chunky-dmg.png', 'dist/DS_Store', 'dist/Chunky.icns'],
+			outputs=['build/' + version.dmg_file()],
+			salt=salt),
+	]
+
+def build_release(version, use_cache=True):
 	if version.suffix:
 		print("Error: non-release version string speicifed (remove suffix)")
 		print("Hint: add the -snapshot flag to build snapshot")
 		sys.exit(1)
 	print("Ready to build version %s (@%s)!" % (version.full, version.updatesite))
-	if raw_input('Build release? [y/N] ') == 'y':
-		check_call('Gradle build',
-				['./gradlew', '--rerun-tasks', '-PnewVersion=' + version.full,
-				'tarball', 'releaseJar', 'releaseZip', 'documentation', 'release'])
-		check_call('Ant build', ['ant', '-Dversion=' + version.full, 'nsi', 'macApp'])
-		check_call('NSIS', nsis(['Chunky.nsi']))
-		# https://stackoverflow.com/a/7553878/1250278
-		os.makedirs('dmgdir/.background')
-		copyfile('dist/chunky-dmg.png', 'dmgdir/.background/background.png')
-		copyfile('dist/DS_Store', 'dmgdir/.DS_Store')
-		os.symlink('/Applications', 'dmgdir/Applications')
-		copyfile('dist/Chunky.icns', 'dmgdir/.Volume.icns')
-		check_call('DMG build',
-				'genisoimage -V Chunky -D -R -apple -no-pad -o'.split() \
-				+ ['build/Chunky-%s.dmg' % version.full, 'dmgdir'])
-		shutil.rmtree('dmgdir') # Cleanup.
+	# When the plan already says where to publish, log in to Launchpad while
+	# the release is building.
+	lp_session = None
+	if plan.answers.get('launchpad') == 'y' and plan.has('production'):
+		lp_session = Future(lp_login)
+	if ask('build', 'Build release? [y/N] ') == 'y':
+		run_stages(release_stages(version), cache=StageCache() if use_cache else None)
 		version.sign_files()
-	if raw_input('Publish to Launchpad? [y/N] ') == 'y':
-		(is_new, exe, dmg, zip, jar) = publish_launchpad(version)
-		patch_url(version, jar)
-		write_release_notes(version, exe, dmg, zip)
-	if raw_input('Publish to FTP? [y/N] ') == 'y':
-		publish_ftp(version)
-	if raw_input('Post release thread? [y/N] ') == 'y':
-		post_release_thread(version)
-	if raw_input('Update documentation? [y/N] ') == 'y':
-		update_docs(version)
+		credentials.flush()
+	steps = []
+	if ask('launchpad', 'Publish to Launchpad? [y/N] ') == 'y':
+		if not lp_session:
+			lp_session = Future(lp_login)
+		def launchpad_step():
+			(launchpad, server) = lp_session.result()
+			(is_new, exe, dmg, zip, jar) = publish_launchpad(version, launchpad, server)
+			build_manifest(version, jar_url=jar)
+			write_release_notes(version, exe, dmg, zip)
+		steps.append(PublishStep('launchpad', launchpad_step))
+	# The update site needs the patched latest.json, and the release thread
+	# and documentation need the release notes written after the Launchpad
+	# upload. The steps only wait for Launchpad when it is published in this
+	# run.
+	after_launchpad = [step.name for step in steps]
+	if ask('ftp', 'Publish to FTP? [y/N] ') == 'y':
+		steps.append(PublishStep('ftp', lambda: publish_ftp(version), after_launchpad))
+	# The release is only announced once the published files are verified.
+	published = [step.name for step in steps]
+	if published:
+		steps.append(PublishStep('verify', lambda: verify_published(version,
+				lp_server=lp_session.result()[1] if 'launchpad' in published else None,
+				manifest='latest.json' if 'ftp' in published else None), published))
+	if ask('reddit', 'Post release thread? [y/N] ') == 'y':
+		steps.append(PublishStep('reddit', lambda: post_release_thread(version),
+				after_launchpad + [name for name in ['verify'] if published]))
+	if ask('docs', 'Update documentation? [y/N] ') == 'y':
+		steps.append(PublishStep('docs', lambda: update_docs(version), after_launchpad))
+	run_publish(steps)
+
+"""A publishing step of a release. The run function takes no arguments;
+the step fails if it raises or exits. Deps are the names of steps that must
+succeed before this step starts."""
+class PublishStep:
+	def __init__(self, name, run, deps=[]):
+		self.name = name
+		self.run = run
+		self.deps = deps
+		self.status = 'pending'
+		self.seconds = 0
+		self.error = None
+
+	def execute(self):
+		with profiler.span(self.name, 'publish') as trace_args:
+			start = time.time()
+			try:
+				self.run()
+				self.status = 'done'
+			except SystemExit as e:
+				self.status = 'failed'
+				self.error = 'exited with status %s' % e.code
+			except:
+				self.status = 'failed'
+				self.error = traceback.format_exc().strip().splitlines()[-1]
+				traceback.print_exc()
+			self.seconds = time.time() - start
+			trace_args['status'] = self.status
+
+# Runs publishing steps as soon as their dependencies have succeeded, so
+# that independent steps upload at the same time. Unlike the build, a failed
+# step does not stop the other steps; only the steps depending on it are
+# skipped. Prints a combined report and exits with an error if any step did
+# not succeed.
+def run_publish(steps):
+	if not steps:
+		return
+	by_name = dict((step.name, step) for step in steps)
+	completed = Queue.Queue()
+	running = 0
+	while True:
+		for step in [s for s in steps if s.status == 'pending']:
+			deps = [by_name[dep].status for dep in step.deps]
+			if any(status in ('failed', 'skipped') for status in deps):
+				step.status = 'skipped'
+				step.error = 'depends on ' + join(step.deps, ', ')
+			elif all(status == 'done' for status in deps):
+				step.status = 'running'
+				thread = threading.Thread(target=lambda step=step:
+						completed.put(step.execute()))
+				thread.daemon = True
+				thread.start()
+				running += 1
+		if not running:
+			break
+		completed.get()
+		running -= 1
+	print("")
+	print("Publish report:")
+	for step in steps:
+		print("    %-10s %-8s %6.1f s  %s" % (step.name, step.status, step.seconds,
+				step.error or ''))
+	if any(step.status != 'done' for step in steps):
+		print("Error: publishing did not complete.")
+		sys.exit(1)
 
 # Builds NSIS command line with given args.
 def nsis(args):
 	return ['wine', path.expanduser('~/nsis-3.03/makensis.exe')] + args
 
-def build_snapshot(version):
+# Builds and publishes a snapshot. With rerun=False, Gradle reuses the
+# outputs of the previous build that are still up to date.
+def build_snapshot(version, rerun=True):
 	if not version.suffix:
 		print("Error: non-snapshot version string speicifed (add suffix)")
 		sys.exit(1)
 	print("Ready to build snapshot %s (@%s)!" % (version.full, version.updatesite))
-	if raw_input('Build snapshot? [y/N] ') == "y":
-		while call(['git', 'tag', '-a', version.full, '-m', 'Snapshot build']) != 0:
-			if raw_input("Delete tag and try again? [y/N] ") == "y":
-				if call(['git', 'tag', '-d', version.full]) == 0:
+	if ask('build', 'Build snapshot? [y/N] ') == "y":
+		while traced_call(['git', 'tag', '-a', version.full, '-m', 'Snapshot build'])[0] != 0:
+			if ask('delete_tag', "Delete tag and try again? [y/N] ") == "y":
+				if traced_call(['git', 'tag', '-d', version.full])[0] == 0:
 					continue
 			sys.exit(1)
-		check_call('snapshot build',
-				['./gradlew', '--rerun-tasks', '-PnewVersion=' + version.full, 'releaseJar'])
-	if raw_input('Publish snapshot to FTP? [y/N] ') == "y":
-		publish_snapshot_ftp(version)
-	if raw_input('Post snapshot thread? [y/N] ') == "y":
-		post_snapshot_thread(version)
+		with profiler.span('gradle', 'stage'):
+			check_call('snapshot build',
+					['./gradlew'] + (['--rerun-tasks'] if rerun else [])
+					+ ['-PnewVersion=' + version.full, 'releaseJar'])
+	if ask('ftp', 'Publish snapshot to FTP? [y/N] ') == "y":
+		with profiler.span('ftp', 'publish'):
+			publish_snapshot_ftp(version)
+		with profiler.span('verify', 'publish'):
+			verify_published(version, manifest='snapshot.json')
+	if ask('reddit', 'Post snapshot thread? [y/N] ') == "y":
+		with profiler.span('reddit', 'publish'):
+			post_snapshot_thread(version)
+
+def load_snapshot_state():
+	if not path.exists(SNAPSHOT_STATE):
+		return {}
+	with open(SNAPSHOT_STATE, 'r') as f:
+		return json.load(f)
+
+# Returns the next unused snapshot version after the given one, e.g.
+# 2.4.0-snapshot3 after 2.4.0-snapshot2 or 2.4.0-snapshot.
+def next_snapshot_name(base, number):
+	prefix = base.rstrip(string.digits)
+	while True:
+		number += 1
+		name = '%s%d' % (prefix, number)
+		if traced_call(['git', 'rev-parse', '-q', '--verify', 'refs/tags/' + name],
+				stdout=PIPE)[0] != 0:
+			return (name, number)
+
+# Polls the remote of the release branch, and publishes a snapshot when the
+# branch has been quiet for WATCH_DEBOUNCE seconds and its tree differs from
+# the last published snapshot. The Gradle build directory is kept between
+# snapshots, so each build only redoes the tasks affected by the changes.
+def watch_snapshots(base):
+	if not base.suffix:
+		print("Error: watch mode needs a snapshot version (add suffix)")
+		sys.exit(1)
+	branch = os.environ.get('RELEASE_GIT_BRANCH', 'master')
+	for (key, answer) in [('build', 'y'), ('ftp', 'y'), ('reddit', 'n'), ('delete_tag', 'n')]:
+		plan.answers.setdefault(key, answer)
+	plan.unattended = True
+	state = load_snapshot_state()
+	number = int(re.search('(\\d*)$', base.full).group(1) or 0)
+	number = max(number, state.get('number', 0))
+	failed_tree = None
+	last_head = None
+	changed_at = None
+	print("Watching %s for snapshots of %s" % (branch, base.full))
+	while True:
+		traced_call(['git', 'fetch', '-q', 'origin', branch])
+		head = traced_call(['git', 'rev-parse', 'origin/' + branch], stdout=PIPE)[1].strip()
+		if head != last_head:
+			last_head = head
+			changed_at = time.time()
+		elif changed_at and time.time() - changed_at >= WATCH_DEBOUNCE:
+			changed_at = None
+			tree = traced_call(['git', 'rev-parse', head + '^{tree}'], stdout=PIPE)[1].strip()
+			if tree not in (state.get('tree'), failed_tree):
+				(name, next_number) = next_snapshot_name(base.full, number)
+				print("Branch %s changed (%s), building snapshot %s" % (branch, head[:10], name))
+				try:
+					check_call('git', ['git', 'checkout', '-q', '--detach', head])
+					snapshot = Version(name, load=plan.answers['reddit'] == 'y')
+					with recorded_run('snapshot', snapshot):
+						build_snapshot(snapshot, rerun=False)
+				except SystemExit:
+					print("Snapshot %s failed, waiting for new commits" % name)
+					failed_tree = tree
+				except Exception:
+					# Network errors of the uploads must not stop the watcher.
+					traceback.print_exc()
+					print("Snapshot %s failed, waiting for new commits" % name)
+					failed_tree = tree
+				else:
+					number = next_number
+					state = dict(tree=tree, commit=head, version=name, number=number,
+							published=datetime.now().isoformat())
+					write_atomic(SNAPSHOT_STATE, json.dumps(state))
+					credentials.flush()
+					save_checksum_cache()
+					print("Published snapshot %s" % name)
+		time.sleep(WATCH_INTERVAL)
+
+# Opens the build history database, creating the tables on first use. Rows
+# are only ever added; the triggers reject updates and deletes.
+def open_history(filepath=HISTORY_DB):
+	parent = path.dirname(filepath)
+	if parent and not path.exists(parent):
+		os.makedirs(parent)
+	db = sqlite3.connect(filepath, timeout=60)
+	db.executescript('''
+		CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, kind TEXT,
+			version TEXT, git_commit TEXT, started REAL, seconds REAL, status TEXT);
+		CREATE TABLE IF NOT EXISTS stages (run INTEGER REFERENCES runs(id),
+			name TEXT, category TEXT, seconds REAL, cached INTEGER);
+		CREATE TABLE IF NOT EXISTS artifacts (run INTEGER REFERENCES runs(id),
+			name TEXT, bytes INTEGER);
+		CREATE TABLE IF NOT EXISTS uploads (run INTEGER REFERENCES runs(id),
+			name TEXT, bytes INTEGER, seconds REAL);
+		CREATE INDEX IF NOT EXISTS runs_version ON runs (version, git_commit);
+	''')
+	for table in ['runs', 'stages', 'artifacts', 'uploads']:
+		for action in ['UPDATE', 'DELETE']:
+			db.execute('''CREATE TRIGGER IF NOT EXISTS %s_no_%s BEFORE %s ON %s
+				BEGIN SELECT RAISE(ABORT, 'build history is append-only'); END'''
+				% (table, action.lower(), action, table))
+	return db
+
+# Records a build in the history database: the duration of each stage and
+# publishing step, the sizes of the artifacts, and the uploads, as traced
+# by the profiler while the body of the with statement ran. Failed builds
+# are recorded too.
+@contextlib.contextmanager
+def recorded_run(kind, version):
+	first_event = len(profiler.events)
+	start = time.time()
+	status = 'failed'
+	try:
+		yield
+		status = 'done'
+	finally:
+		try:
+			record_run(kind, version, start, status, profiler.events[first_event:])
+		except (sqlite3.Error, OSError) as e:
+			print("Warning: failed to record build history: %s" % e)
+
+def record_run(kind, version, start, status, events):
+	(returncode, commit) = traced_call(['git', 'rev-parse', 'HEAD'], stdout=PIPE)
+	db = open_history()
+	with db:
+		run = db.execute('''INSERT INTO runs (kind, version, git_commit, started, seconds,
+				status) VALUES (?, ?, ?, ?, ?, ?)''', (kind, version.full,
+				commit.strip() if returncode == 0 else None, start, time.time() - start,
+				status)).lastrowid
+		for event in events:
+			if event['cat'] in ('stage', 'publish', 'delta'):
+				db.execute('INSERT INTO stages VALUES (?, ?, ?, ?, ?)', (run, event['name'],
+						event['cat'], event['dur'] / 1e6, int(bool(event['args'].get('cached')))))
+			elif event['cat'] == 'upload':
+				db.execute('INSERT INTO uploads VALUES (?, ?, ?, ?)', (run,
+						event['name'][len('upload '):], event['args']['bytes'], event['dur'] / 1e6))
+		artifacts = version.artifacts() if kind == 'release' else [version.jar_file()]
+		for name in artifacts + [CHECKSUMS_FILE]:
+			if path.exists('build/' + name):
+				db.execute('INSERT INTO artifacts VALUES (?, ?, ?)',
+						(run, name, path.getsize('build/' + name)))
+	db.close()
+
+# Returns the median of a non-empty list.
+def median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+	if len(values) % 2:
+		return values[middle]
+	return (values[middle - 1] + values[middle]) / 2.0
+
+# Prints the recent builds of each kind, and compares the stages, total time
+# and upload rate of the latest successful build with the median of the
+# HISTORY_BASELINE builds before it. Cached stages are left out, since they
+# would make the baseline look faster than a real rebuild. Exits with an
+# error if anything regressed by more than the threshold.
+def history_report(threshold=REGRESSION_THRESHOLD, baseline=HISTORY_BASELINE):
+	if not path.exists(HISTORY_DB):
+		print("No build history in %s" % HISTORY_DB)
+		return
+	db = open_history()
+	regressions = []
+	for kind in ['release', 'snapshot']:
+		runs = db.execute('''SELECT id, version, git_commit, started, seconds, status
+				FROM runs WHERE kind = ? ORDER BY id DESC LIMIT ?''', (kind, baseline + 1)).fetchall()
+		if not runs:
+			continue
+		print("")
+		print("Recent %s builds:" % kind)
+		print("    %-18s %-10s %-16s %10s %10s  %s" % ('version', 'commit', 'date',
+				'total (s)', 'MiB/s', 'status'))
+		rates = {}
+		for (run, version, commit, started, seconds, status) in reversed(runs):
+			(sent, upload_time) = db.execute('''SELECT SUM(bytes), SUM(seconds) FROM uploads
+					WHERE run = ?''', (run,)).fetchone()
+			if sent and upload_time:
+				rates[run] = sent / 1048576.0 / upload_time
+			print("    %-18s %-10s %-16s %10.1f %10s  %s" % (version, (commit or '-')[:8],
+					datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M'), seconds,
+					'%.2f' % rates[run] if run in rates else '-', status))
+		done = [run for run in runs if run[5] == 'done']
+		if len(done) < 2:
+			continue
+		(latest, previous) = (done[0], done[1:])
+		def stage_times(run):
+			return dict(db.execute('''SELECT name, SUM(seconds) FROM stages
+					WHERE run = ? AND cached = 0 GROUP BY name''', (run[0],)).fetchall())
+		latest_stages = stage_times(latest)
+		history = [stage_times(run) for run in previous]
+		print("")
+		print("    %-18s %10s %10s %8s" % ('stage', 'latest', 'baseline', 'change'))
+		rows = [(name, latest_stages[name], [h[name] for h in history if name in h])
+				for name in sorted(latest_stages.keys())]
+		rows.append(('total', latest[4], [run[4] for run in previous]))
+		for (name, value, past) in rows:
+			if not past:
+				print("    %-18s %9.1fs %10s %8s" % (name, value, '-', 'new'))
+				continue
+			base = median(past)
+			change = (value - base) / base if base > 0 else 0
+			flag = ''
+			if change > threshold:
+				flag = '  REGRESSED'
+				regressions.append('%s %s' % (kind, name))
+			print("    %-18s %9.1fs %9.1fs %+7.0f%%%s" % (name, value, base, change * 100, flag))
+		past_rates = [rates[run[0]] for run in previous if run[0] in rates]
+		if latest[0] in rates and past_rates:
+			base = median(past_rates)
+			change = (rates[latest[0]] - base) / base
+			flag = ''
+			if -change > threshold:
+				flag = '  REGRESSED'
+				regressions.append('%s upload rate' % kind)
+			print("    %-18s %7.2f/s %7.2f/s %+7.0f%%%s" % ('upload MiB', rates[latest[0]],
+					base, change * 100, flag))
+	db.close()
+	if regressions:
+		print("")
+		print("Regressions beyond %.0f%%: %s" % (threshold * 100, join(regressions, ', ')))
+		sys.exit(1)
+
+reddit_session = None
 
+# Logs in to Reddit. The session is reused for the rest of the run.
 def reddit_login():
+	global reddit_session
+	if reddit_session:
+		return reddit_session
 	while True:
 		id = credentials.get('reddit client ID')
 		secret = credentials.get('reddit client secret')
@@ -304,72 +1370,246 @@ def reddit_login():
 				code = raw_input('Enter access code (from result URL): ')
 				refresh_token = r.auth.authorize(code)
 				credentials.put('refresh_token', refresh_token)
+			reddit_session = r
 			return r
 		except:
-			if raw_input('Login failed. Try again? [y/N] ') != "y":
+			if ask('retry', 'Login failed. Try again? [y/N] ') != "y":
 				raise
 
-def ftp_login():
-	while True:
-		user = credentials.get('ftp user')
-		pw = credentials.getpass('ftp password')
+"FTP connection that is reused for every upload to the update site in a run."
+class FtpSession:
+	def __init__(self, host=FTP_HOST, port=FTP_PORT, blocksize=FTP_BLOCK_SIZE):
+		self.host = host
+		self.port = port
+		self.blocksize = blocksize
+		self.ftp = None
+		self.home = None
+		self.dir = ''
+
+	# Logs in and returns to the current directory of the session.
+	def connect(self):
+		while True:
+			user = credentials.get('ftp user')
+			pw = credentials.getpass('ftp password')
+			try:
+				ftp = ftplib.FTP()
+				ftp.connect(self.host, self.port)
+				ftp.login(user, pw)
+				break
+			except ftplib.error_perm:
+				credentials.remove('ftp user')
+				credentials.remove('ftp password')
+				print("Login failed, please try again")
+		self.ftp = ftp
+		self.home = ftp.pwd()
+		if self.dir:
+			ftp.cwd(self.dir)
+
+	# Reconnects if the connection was never opened or has been dropped.
+	def ensure_connected(self):
+		if self.ftp is not None:
+			try:
+				self.ftp.voidcmd('NOOP')
+				return
+			except ftplib.all_errors:
+				self.close()
+		self.connect()
+
+	# Changes to a directory relative to the login directory.
+	def cwd(self, dirname):
+		self.ensure_connected()
+		if dirname != self.dir:
+			self.ftp.cwd(self.home)
+			if dirname:
+				self.ftp.cwd(dirname)
+			self.dir = dirname
+
+	# Returns the size of a remote file in the current directory, or 0 if
+	# it does not exist.
+	def remote_size(self, remotename):
+		self.ensure_connected()
 		try:
-			ftp = ftplib.FTP('ftp.llbit.se')
-			ftp.login(user, pw)
-			return ftp
+			self.ftp.voidcmd('TYPE I')
+			return self.ftp.size(remotename) or 0
 		except ftplib.error_perm:
-			credentials.remove('ftp user')
-			credentials.remove('ftp password')
-			print("Login failed, please try again")
+			return 0
+
+	# Returns the content of a small remote file, or None if it does not exist.
+	def read(self, remotename):
+		self.ensure_connected()
+		buf = io.BytesIO()
+		try:
+			self.ftp.retrbinary('RETR ' + remotename, buf.write)
+		except ftplib.error_perm:
+			return None
+		return buf.getvalue()
+
+	def write(self, remotename, data):
+		self.ensure_connected()
+		self.ftp.storbinary('STOR ' + remotename, io.BytesIO(data), self.blocksize)
+
+	# Streams a remote file in the current directory to a writer function.
+	# Returns False if the remote file does not exist.
+	def fetch(self, remotename, write):
+		self.ensure_connected()
+		try:
+			self.ftp.retrbinary('RETR ' + remotename, write, self.blocksize)
+		except ftplib.error_perm:
+			return False
+		return True
+
+	# Downloads a remote file in the current directory to a local file.
+	# Returns False if the remote file does not exist.
+	def download(self, remotename, filepath):
+		self.ensure_connected()
+		try:
+			with open(filepath + '.part', 'wb') as f:
+				self.ftp.retrbinary('RETR ' + remotename, f.write, self.blocksize)
+		except ftplib.error_perm:
+			os.remove(filepath + '.part')
+			return False
+		os.rename(filepath + '.part', filepath)
+		return True
+
+	# Uploads a local file to the current directory. A SHA-256 sidecar file
+	# (<name>.sha256) records the content of each upload: when it matches the
+	# local file, a complete remote file is skipped and a partial one is
+	# resumed. An upload interrupted in this run is also resumed from the
+	# size already on the server.
+	def upload(self, filepath, remotename):
+		size = path.getsize(filepath)
+		digest = file_digest(filepath)
+		offset = 0
+		if self.read(remotename + '.sha256') == digest:
+			offset = self.remote_size(remotename)
+			if offset == size:
+				print("Skipping %s: already uploaded" % remotename)
+				return
+			if offset > size:
+				offset = 0
+		else:
+			# Empty the old file before the sidecar names the new content, so
+			# that an interrupted run never resumes onto or skips old bytes.
+			if self.remote_size(remotename) > 0:
+				self.write(remotename, '')
+			self.write(remotename + '.sha256', digest)
+		resumed_at = offset
+		start = time.time()
+		for attempt in range(FTP_RETRIES + 1):
+			try:
+				self.ensure_connected()
+				with open(filepath, 'rb') as f:
+					f.seek(offset)
+					self.ftp.storbinary('STOR ' + remotename, f, self.blocksize,
+							rest=offset if offset else None)
+				break
+			except ftplib.error_perm:
+				raise
+			except ftplib.all_errors:
+				if attempt == FTP_RETRIES:
+					raise
+				self.close()
+				offset = self.remote_size(remotename)
+				if offset > size:
+					offset = 0
+				print("Upload of %s interrupted, resuming at byte %d" % (remotename, offset))
+		report_throughput(remotename, size - resumed_at, time.time() - start)
+
+	def close(self):
+		if self.ftp is not None:
+			try:
+				self.ftp.quit()
+			except ftplib.all_errors:
+				self.ftp.close()
+			self.ftp = None
+
+ftp_session = None
+
+# Returns the FTP session for this run, logging in on first use.
+def get_ftp_session():
+	global ftp_session
+	if ftp_session is None:
+		ftp_session = FtpSession()
+		atexit.register(ftp_session.close)
+	return ftp_session
+
+# Uploads the launcher, and optionally a version manifest and the core
+# library, to the update site of the given version. The manifest is
+# regenerated from the local libraries before it is uploaded.
+# The core library is uploaded with delta patches from the previously
+# published core jars, before the manifest that advertises them.
+def publish_update_site(version, manifest=None, core_lib=False):
+	session = get_ftp_session()
+	patches = None
+	if core_lib:
+		patches = make_core_patches(version, session, manifest)
+	if manifest:
+		build_manifest(version, manifest, patches=patches)
+	session.cwd(version.updatesite)
+	session.upload('build/ChunkyLauncher.jar', 'ChunkyLauncher.jar')
+	if core_lib:
+		session.cwd(version.updatesite + '/lib')
+		session.upload('build/' + version.jar_file(), version.jar_file())
+		for patch in patches:
+			session.upload(path.join('build', 'patches', patch['name']), patch['name'])
+		remember_published_jar(version)
+	if manifest:
+		session.cwd(version.updatesite)
+		session.upload(manifest, manifest)
 
 def publish_snapshot_ftp(version):
-	ftp = ftp_login()
-	ftp.cwd(version.updatesite)
-	with open('build/ChunkyLauncher.jar', 'rb') as f:
-		ftp.storbinary('STOR ChunkyLauncher.jar', f)
-	with open('latest.json', 'rb') as f:
-		ftp.storbinary('STOR snapshot.json', f)
-	ftp.cwd('lib')
-	with open('build/chunky-core-%s.jar' % version.full, 'rb') as f:
-		ftp.storbinary('STOR chunky-core-%s.jar' % version.full, f)
-	ftp.quit()
+	publish_update_site(version, 'snapshot.json', core_lib=True)
 
 def publish_ftp(version):
-	ftp = ftp_login()
-	ftp.cwd(version.updatesite)
-	with open('build/ChunkyLauncher.jar', 'rb') as f:
-		ftp.storbinary('STOR ChunkyLauncher.jar', f)
-	with open('latest.json', 'rb') as f:
-		ftp.storbinary('STOR latest.json', f)
-	ftp.cwd('lib')
-	with open('build/chunky-core-%s.jar' % version.full, 'rb') as f:
-		ftp.storbinary('STOR chunky-core-%s.jar' % version.full, f)
-	ftp.quit()
+	publish_update_site(version, 'latest.json', core_lib=True)
 
 def publish_launcher(version):
-	ftp = ftp_login()
-	ftp.cwd(version.updatesite)
-	with open('build/ChunkyLauncher.jar', 'rb') as f:
-		ftp.storbinary('STOR ChunkyLauncher.jar', f)
-	ftp.quit()
+	publish_update_site(version)
+
+# Clones or updates the docs checkout. The checkout is shallow and sparse:
+# only the latest commit, and only the release notes and version properties,
+# are fetched and checked out.
+def checkout_docs():
+	if path.exists(path.join(DOCS_CHECKOUT, '.git')):
+		check_call('git', ['git', 'remote', 'set-url', 'origin', DOCS_REMOTE],
+				cwd=DOCS_CHECKOUT)
+		check_call('fetching documentation repo',
+				['git', 'fetch', '--depth', '1', 'origin', 'master'], cwd=DOCS_CHECKOUT)
+		check_call('git', ['git', 'reset', '--hard', 'FETCH_HEAD'], cwd=DOCS_CHECKOUT)
+	else:
+		if path.exists(DOCS_CHECKOUT):
+			shutil.rmtree(DOCS_CHECKOUT)
+		parent = path.dirname(DOCS_CHECKOUT)
+		if parent and not path.exists(parent):
+			os.makedirs(parent)
+		check_call('cloning documentation repo',
+				['git', 'clone', '--depth', '1', '--no-checkout', '--branch', 'master',
+					DOCS_REMOTE, DOCS_CHECKOUT])
+		check_call('git', ['git', 'sparse-checkout', 'set', '--no-cone',
+				'/docs/release/', '/version.properties'], cwd=DOCS_CHECKOUT)
+		check_call('git', ['git', 'checkout', 'master'], cwd=DOCS_CHECKOUT)
 
 def update_docs(version):
 	version_links = 'build/version-%s.properties' % version.full
 	if not path.exists(version_links):
 		print('Error: can not update documentation because %s does not exist. You must publish to launchpad to generate this file.' % version_links)
 		return
-	docs_dir = 'docs'
-	docs_repo = 'github.com/llbit/chunky-docs.git'
-	if path.exists(docs_dir):
-		with cd(docs_dir):
-			check_call('git', ['git', 'pull'])
-	else:
-		check_call('cloning documentation repo',
-				['git', 'clone', "https://%s" % docs_repo, docs_dir])
+	parent = path.dirname(DOCS_CHECKOUT)
+	if parent and not path.exists(parent):
+		os.makedirs(parent)
+	with file_lock(DOCS_CHECKOUT + '.lock'):
+		publish_docs(version)
+
+# Commits the release notes and version properties of a version to the docs
+# repository.
+def publish_docs(version):
+	version_links = 'build/version-%s.properties' % version.full
+	checkout_docs()
+	docs_dir = DOCS_CHECKOUT
 	copyfile(version_links, path.join(docs_dir, 'version.properties'))
 	version_dir = '%s/docs/release/%s' % (docs_dir, version.full)
 	if not path.exists(version_dir):
-		os.mkdir(version_dir)
+		os.makedirs(version_dir)
 	with codecs.open('build/release_notes-%s.md' % version.full,'r',encoding='utf-8') as src:
 		with codecs.open('%s/docs/release/%s/release_notes.md' % (docs_dir, version.full),
 				'w', encoding='utf-8') as dst:
@@ -378,16 +1618,239 @@ def update_docs(version):
 
 ''' % version.full)
 			dst.write(src.read())
-	with cd(docs_dir):
-		check_call('git', 'git add .'.split())
-		check_call('git', ['git', 'commit', '-m', 'Release %s' % version.full])
-		gh_user = credentials.get('github user')
-		gh_token = credentials.getpass('github token')
-		check_call('git',
-				['git', 'push', 'https://%s:%s@%s' % (gh_user, gh_token, docs_repo), 'master'])
-
-def lp_upload_file(version, release, filename, description, content_type, file_type):
-	# TODO: handle re-uploads.
+	check_call('git', ['git', 'add', '--sparse', '--', 'version.properties',
+			'docs/release/%s/release_notes.md' % version.full], cwd=docs_dir)
+	if traced_call(['git', 'diff', '--cached', '--quiet'], cwd=docs_dir)[0] == 0:
+		print("Documentation is already up to date.")
+		return
+	check_call('git', ['git', 'commit', '-m', 'Release %s' % version.full], cwd=docs_dir)
+	check_call('git', ['git', 'push', github_push_url(DOCS_REMOTE), 'HEAD:master'],
+			cwd=docs_dir)
+
+# Adds the GitHub credentials to an https remote URL.
+def github_push_url(remote):
+	if not remote.startswith('https://'):
+		return remote
+	gh_user = credentials.get('github user')
+	gh_token = credentials.getpass('github token')
+	return 'https://%s:%s@%s' % (gh_user, gh_token, remote[len('https://'):])
+
+# Prints the transfer rate for an uploaded file and records the upload in
+# the trace.
+def report_throughput(filename, size, seconds):
+	end = time.time()
+	profiler.record('upload ' + filename, 'upload', end - seconds, end,
+			{'bytes': size, 'bytes_per_s': size / max(seconds, 1e-6)})
+	seconds = max(seconds, 1e-6)
+	print("Uploaded %s: %.1f MiB in %.1f s (%.2f MiB/s)"
+			% (filename, size / 1048576.0, seconds, size / 1048576.0 / seconds))
+
+# Copies the file at filepath to the writer function in UPLOAD_CHUNK_SIZE
+# blocks, so that memory use does not depend on the file size.
+def stream_file(filepath, write):
+	with open(filepath, 'rb') as f:
+		while True:
+			chunk = f.read(UPLOAD_CHUNK_SIZE)
+			if not chunk:
+				break
+			write(chunk)
+
+"Size, SHA-256 and MD5 digests of a file."
+class Checksum:
+	def __init__(self, size, sha256, md5):
+		self.size = size
+		self.sha256 = sha256
+		self.md5 = md5
+
+checksums = None
+checksums_lock = threading.Lock()
+
+# Loads the checksum cache of previous runs. Called with checksums_lock held.
+def load_checksum_cache():
+	global checksums
+	checksums = {}
+	if path.exists(CHECKSUM_CACHE):
+		try:
+			with open(CHECKSUM_CACHE, 'r') as f:
+				for (key, entry) in json.load(f).items():
+					checksums[key] = ((entry['mtime'], entry['size']),
+							Checksum(entry['size'], entry['sha256'], entry['md5']))
+		except (IOError, ValueError, KeyError):
+			print("Warning: ignoring corrupt checksum cache %s" % CHECKSUM_CACHE)
+			checksums = {}
+
+# Writes the checksum cache, keeping only files that still exist unchanged.
+def save_checksum_cache():
+	with checksums_lock:
+		if checksums is None:
+			return
+		entries = {}
+		for (key, (stamp, checksum)) in checksums.items():
+			if path.isfile(key) and (path.getmtime(key), path.getsize(key)) == stamp:
+				entries[key] = dict(mtime=stamp[0], size=stamp[1],
+						sha256=checksum.sha256, md5=checksum.md5)
+	if path.isdir(path.dirname(CHECKSUM_CACHE)):
+		write_atomic(CHECKSUM_CACHE, json.dumps(entries))
+
+# Computes the checksum of a file, reading it only once. The file is
+# memory-mapped when possible, otherwise it is read in large blocks.
+def compute_checksum(filepath):
+	sha256 = hashlib.sha256()
+	md5 = hashlib.md5()
+	size = 0
+	with open(filepath, 'rb') as f:
+		try:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (mmap.error, ValueError):
+			data = None
+		if data is not None:
+			try:
+				size = len(data)
+				for offset in xrange(0, size, CHECKSUM_CHUNK_SIZE):
+					chunk = buffer(data, offset, CHECKSUM_CHUNK_SIZE)
+					sha256.update(chunk)
+					md5.update(chunk)
+			finally:
+				data.close()
+		else:
+			while True:
+				chunk = f.read(CHECKSUM_CHUNK_SIZE)
+				if not chunk:
+					break
+				size += len(chunk)
+				sha256.update(chunk)
+				md5.update(chunk)
+	return Checksum(size, sha256.hexdigest(), md5.hexdigest())
+
+# Returns the checksum of a file. Checksums are cached by path, mtime and
+# size, also between runs, so the signing, upload dedupe, manifest and
+# verification steps do not read an unchanged file again.
+def file_checksum(filepath):
+	st = os.stat(filepath)
+	key = path.abspath(filepath)
+	stamp = (st.st_mtime, st.st_size)
+	with checksums_lock:
+		if checksums is None:
+			load_checksum_cache()
+		cached = checksums.get(key)
+	if cached and cached[0] == stamp:
+		return cached[1]
+	checksum = compute_checksum(filepath)
+	with checksums_lock:
+		checksums[key] = (stamp, checksum)
+	return checksum
+
+# Computes the hex digest of a file with the given hashlib algorithm.
+def file_digest(filepath, algorithm='sha256'):
+	if algorithm in ('sha256', 'md5'):
+		return getattr(file_checksum(filepath), algorithm)
+	h = hashlib.new(algorithm)
+	stream_file(filepath, h.update)
+	return h.hexdigest()
+
+# Writes build/SHA256SUMS for the given build artifacts, in the format of
+# sha256sum. The artifacts are hashed in parallel.
+def write_checksums(filenames, workers=SIGN_WORKERS):
+	lines = []
+	for (filename, checksum, error) in parallel_map(
+			lambda fn: file_checksum('build/' + fn), filenames, workers):
+		if error:
+			raise error[0], error[1], error[2]
+		lines.append('%s  %s\n' % (checksum.sha256, filename))
+	with open('build/' + CHECKSUMS_FILE, 'w') as f:
+		f.write(join(lines, ''))
+
+# Writes a file by renaming a complete temporary file over it, so that
+# readers never see a partially written file.
+def write_atomic(filepath, data):
+	(fd, tmp) = tempfile.mkstemp(dir=path.dirname(filepath) or '.',
+			prefix='.' + path.basename(filepath) + '.')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+		os.chmod(tmp, 0644)
+		os.rename(tmp, filepath)
+	except:
+		os.remove(tmp)
+		raise
+
+# Reads a checksum manifest into a {filename: sha256} dict. Returns an empty
+# dict if the manifest does not exist.
+def read_checksums(filepath='build/' + CHECKSUMS_FILE):
+	if not path.exists(filepath):
+		return {}
+	sums = {}
+	with open(filepath, 'r') as f:
+		for line in f:
+			(digest, _, filename) = line.rstrip('\n').partition('  ')
+			if filename:
+				sums[filename] = digest
+	return sums
+
+# Builds the OAuth header for a Launchpad API request.
+def lp_oauth_header(launchpad):
+	creds = launchpad.credentials
+	params = [
+		('oauth_consumer_key', creds.consumer.key),
+		('oauth_token', creds.access_token.key),
+		('oauth_signature_method', 'PLAINTEXT'),
+		('oauth_signature', '%s&%s' % (urllib.quote(creds.consumer.secret or '', safe=''),
+			urllib.quote(creds.access_token.secret, safe=''))),
+		('oauth_timestamp', str(int(time.time()))),
+		('oauth_nonce', ''.join(random.choice(string.digits) for i in range(16))),
+		('oauth_version', '1.0'),
+	]
+	return 'OAuth realm="https://api.launchpad.net/", ' \
+		+ ', '.join('%s="%s"' % (k, urllib.quote(v, safe='')) for (k, v) in params)
+
+# Calls a named operation on a Launchpad resource as a multipart POST. The
+# files are (field, filename, filepath) tuples, and are streamed from disk
+# instead of being read into memory like launchpadlib does.
+def lp_multipart_post(launchpad, resource_url, fields, files):
+	boundary = '----shipit' + ''.join(random.choice(string.hexdigits) for i in range(24))
+	head = lambda disposition, content_type: (
+		'--%s\r\nContent-Disposition: form-data; %s\r\nContent-Type: %s\r\n\r\n'
+			% (boundary, disposition, content_type))
+	# Body parts are either literal strings or (filepath,) tuples to stream.
+	parts = []
+	for (name, value) in fields:
+		parts.append(head('name="%s"' % name, 'text/plain; charset="utf-8"')
+				+ value.encode('utf-8') + '\r\n')
+	for (name, filename, filepath) in files:
+		parts.append(head('name="%s"; filename="%s"' % (name, filename),
+				'application/octet-stream'))
+		parts.append((filepath,))
+		parts.append('\r\n')
+	parts.append('--%s--\r\n' % boundary)
+	length = sum(path.getsize(part[0]) if isinstance(part, tuple) else len(part)
+			for part in parts)
+	url = urlparse.urlparse(resource_url)
+	if url.scheme == 'http':
+		conn = httplib.HTTPConnection(url.netloc)
+	else:
+		conn = httplib.HTTPSConnection(url.netloc)
+	try:
+		conn.putrequest('POST', url.path)
+		conn.putheader('Authorization', lp_oauth_header(launchpad))
+		conn.putheader('Content-Type', 'multipart/form-data; boundary=%s' % boundary)
+		conn.putheader('Content-Length', str(length))
+		conn.endheaders()
+		for part in parts:
+			if isinstance(part, tuple):
+				stream_file(part[0], conn.send)
+			else:
+				conn.send(part)
+		response = conn.getresponse()
+		body = response.read()
+		if response.status not in (200, 201):
+			raise IOError('Launchpad returned %d %s: %s'
+					% (response.status, response.reason, body))
+	finally:
+		conn.close()
+
+# Uploads a release file and its signature to Launchpad. Raises an
+# exception if the upload failed.
+def lp_upload_file(launchpad, release, filename, description, content_type, file_type):
 	FILE_TYPES = dict(
 		tarball='Code Release Tarball',
 		readme='README File',
@@ -395,27 +1858,83 @@ def lp_upload_file(version, release, filename, description, content_type, file_t
 		changelog='ChangeLog File',
 		installer='Installer file')
 	print("Uploading %s..." % filename)
-	while True:
-		try:
-			signature_fn = filename + '.sig'
-			release_file = release.add_file(
-				filename=filename,
-				description=description,
-				file_content=open('build/' + filename, 'rb').read(),
-				signature_content=open('build/' + signature_fn, 'rb').read(),
-				signature_filename=signature_fn,
-				content_type=content_type,
-				file_type=FILE_TYPES[file_type])
-		except:
-			exc_type, exc_value, exc_traceback = sys.exc_info()
-			print("File upload error (%s):" % exc_type)
-			traceback.print_exception(exc_type, exc_value, exc_traceback)
-			if raw_input("Upload failed. Choose fix: [r]etry or [m]anual upload? ") == "r":
+	signature_fn = filename + '.sig'
+	start = time.time()
+	lp_multipart_post(launchpad, release.self_link, [
+			('ws.op', 'add_file'),
+			('filename', filename),
+			('description', description),
+			('signature_filename', signature_fn),
+			('content_type', content_type),
+			('file_type', FILE_TYPES[file_type]),
+		], [
+			('file_content', filename, 'build/' + filename),
+			('signature_content', signature_fn, 'build/' + signature_fn),
+		])
+	report_throughput(filename, path.getsize('build/' + filename), time.time() - start)
+
+def lp_download_root(server):
+	if server in LP_DOWNLOAD_ROOTS:
+		return LP_DOWNLOAD_ROOTS[server]
+	return lp_uris.lookup_web_root(server).rstrip('/')
+
+def lp_download_url(version, filename, server='production'):
+	return '%s/chunky/%s/%s/+download/%s' \
+		% (lp_download_root(server), version.series, version.milestone, filename)
+
+# Returns the uploads whose files are not already on the release with the
+# same content. Files that exist with different content are deleted from the
+# release so that they can be uploaded again. Files whose remote digest can
+# not be fetched are left alone and reported, since the check failing says
+# nothing about their content.
+def lp_pending_uploads(version, release, uploads, server='production'):
+	existing = dict((f.self_link.rsplit('/', 1)[1], f) for f in release.files)
+	pending = []
+	for upload in uploads:
+		filename = upload[0]
+		if filename in existing:
+			try:
+				remote_md5 = urllib2.urlopen(lp_download_url(version, filename, server)
+						+ '/+md5').read().split()[0]
+			except (urllib2.URLError, IndexError) as e:
+				print("Warning: could not check %s on Launchpad (%s), leaving it in place."
+						% (filename, e))
+				print("Replace it manually if its content is wrong.")
+				continue
+			if remote_md5 == file_digest('build/' + filename, 'md5'):
+				print("Skipping %s: already uploaded" % filename)
 				continue
-			print("Upload %s (%s) manually. Press enter to continue." % (filename, description))
-			raw_input()
-		return 'https://launchpad.net/chunky/%s/%s/+download/%s' \
-			% (version.series, version.milestone, filename)
+			print("Replacing %s: remote content differs" % filename)
+			existing[filename].delete()
+		pending.append(upload)
+	return pending
+
+# Uploads release files concurrently, using at most the given number of
+# parallel uploads. Each upload is a (filename, description, content_type,
+# file_type) tuple. Failed uploads do not stop the others; the errors are
+# reported together when all uploads have finished, and only the failed
+# files are retried.
+def lp_upload_files(launchpad, release, uploads, workers=LP_UPLOAD_WORKERS):
+	pending = list(uploads)
+	while pending:
+		results = parallel_map(lambda upload: lp_upload_file(launchpad, release, *upload),
+				pending, workers)
+		failed = []
+		for (upload, result, error) in results:
+			if error:
+				print("File upload error for %s (%s):" % (upload[0], error[0]))
+				traceback.print_exception(*error)
+				failed.append(upload)
+		if not failed:
+			break
+		print("Failed uploads: %s" % join([upload[0] for upload in failed], ', '))
+		if ask('upload_fix', "Upload failed. Choose fix: [r]etry or [m]anual upload? ") == "r":
+			pending = failed
+			continue
+		for (filename, description, content_type, file_type) in failed:
+			print("Upload %s (%s) manually." % (filename, description))
+		ask('continue', "Press enter to continue.")
+		break
 
 def check_file_exists(filename):
 	if not path.exists('build/' + filename):
@@ -425,58 +1944,153 @@ def check_file_exists(filename):
 		print("Error: required signature for %s not found!" % filename)
 		sys.exit(1)
 
-def publish_launchpad(version):
+"""Local index of the Launchpad releases, milestones and series of a project,
+stored next to the launchpadlib cache. Walking the paginated collections is
+only needed when the index is older than the TTL; lookups then load the
+matching entry directly by its link."""
+class LaunchpadIndex:
+	KINDS = ['releases', 'milestones', 'series']
+
+	def __init__(self, launchpad, project, server, cachedir='lpcache', ttl=LP_INDEX_TTL):
+		self.launchpad = launchpad
+		self.project = project
+		self.path = path.join(cachedir, 'index-%s.json' % server)
+		self.lock_path = path.join(cachedir, 'index-%s.lock' % server)
+		self.ttl = ttl
+		self.index = None
+		self.refreshed = False
+
+	# Locks the index file against the other release processes sharing the
+	# cache directory.
+	def locked(self):
+		parent = path.dirname(self.lock_path)
+		if parent and not path.exists(parent):
+			os.makedirs(parent)
+		return file_lock(self.lock_path)
+
+	def stale(self):
+		return self.index is None or time.time() - self.index['updated'] > self.ttl
+
+	# Reads the stored index, or None if it is missing or unreadable. The
+	# caller must hold the lock.
+	def read(self):
+		if not path.exists(self.path):
+			return None
+		try:
+			with open(self.path, 'r') as f:
+				return json.load(f)
+		except ValueError:
+			print("Warning: ignoring corrupt Launchpad index %s" % self.path)
+			return None
+
+	def load(self):
+		if self.stale():
+			with self.locked():
+				self.index = self.read()
+				if self.stale():
+					self.update()
+		return self.index
+
+	# Rebuilds the index by walking the remote collections once.
+	def refresh(self):
+		with self.locked():
+			self.update()
+
+	def update(self):
+		print("Updating Launchpad index")
+		self.refreshed = True
+		self.index = {
+			'updated': time.time(),
+			'releases': dict((r.version, r.self_link) for r in self.project.releases),
+			'milestones': dict((ms.name, ms.self_link) for ms in self.project.all_milestones),
+			'series': dict((s.name, s.self_link) for s in self.project.series),
+		}
+		self.save()
+
+	def save(self):
+		write_atomic(self.path, json.dumps(self.index))
+
+	# Returns the entry of the given kind and name, or None if there is none.
+	def lookup(self, kind, name):
+		link = self.load()[kind].get(name)
+		if not link and not self.refreshed:
+			# The entry may have been created since the index was built.
+			self.refresh()
+			link = self.index[kind].get(name)
+		if not link:
+			return None
+		try:
+			return self.launchpad.load(link)
+		except Exception:
+			# The entry was removed since the index was built.
+			self.refresh()
+			link = self.index[kind].get(name)
+			return self.launchpad.load(link) if link else None
+
+	# Records a newly created entry.
+	def add(self, kind, name, entry):
+		self.load()
+		with self.locked():
+			# Keep the entries other processes added since it was loaded.
+			self.index = self.read() or self.index
+			self.index[kind][name] = entry.self_link
+			self.save()
+
+lp_sessions = {}
+
+# Asks which Launchpad server to publish to.
+def ask_lp_server():
+	if ask('production', 'Publish to production? [y/N] ') == "y":
+		return 'production'
+	else:
+		return 'staging'
+
+# Asks which Launchpad server to publish to and logs in. The session is
+# reused for the rest of the run. Returns (launchpad, server).
+def lp_login():
+	server = ask_lp_server()
+	if server not in lp_sessions:
+		app_name = 'Releasebot'
+		lp_sessions[server] = launchpadlib.Launchpad.login_with(app_name, server, 'lpcache')
+	return (lp_sessions[server], server)
+
+def publish_launchpad(version, launchpad=None, server=None):
 	# Check that required files exist.
 	check_file_exists(version.jar_file())
 	check_file_exists(version.tar_file())
 	check_file_exists(version.zip_file())
 	check_file_exists(version.exe_file())
 	check_file_exists(version.dmg_file())
-	if raw_input('Publish to production? [y/N] ') == "y":
-		server = 'production'
-		service = launchpadlib.uris.LPNET_SERVICE_ROOT
-	else:
-		server = 'staging'
-		service = launchpadlib.uris.STAGING_SERVICE_ROOT
-
-	app_name = 'Releasebot'
-	launchpad = Launchpad.login_with(app_name, server, 'lpcache')
+	if launchpad is None:
+		(launchpad, server) = lp_login()
 
 	chunky = launchpad.projects['chunky']
+	index = LaunchpadIndex(launchpad, chunky, server)
 
 	# Check if release exists.
-	release = None
-	for r in chunky.releases:
-		if r.version == version.milestone:
-			release = r
-			print("Previous %s release found: will to upload additional files." % version.milestone)
-			break
+	release = index.lookup('releases', version.milestone)
+	if release is not None:
+		print("Previous %s release found: will to upload additional files." % version.milestone)
 
 	is_new_release = release is None
 
 	if release is None:
 		# Check if milestone exists.
-		milestone = None
-		for ms in chunky.all_milestones:
-			if ms.name == version.milestone:
-				milestone = ms
-				break
+		milestone = index.lookup('milestones', version.milestone)
 
 		# Create milestone (and series) if needed.
 		if milestone is None:
-			series = None
-			for s in chunky.series:
-				if s.name == version.series:
-					series = s
-					break
+			series = index.lookup('series', version.series)
 			if series is None:
 				series = chunky.newSeries(
 					name=version.series,
 					summary="The current stable series for Chunky. NB: The code is maintained separately on GitHub.")
+				index.add('series', version.series, series)
 				print("Series %s created. Please manually update the series summary:" % version.series)
 				print(series)
 
 			milestone = series.newMilestone(name=version.milestone)
+			index.add('milestones', version.milestone, milestone)
 			print("Milestone %s created." % version.milestone)
 
 		# Create release.
@@ -484,59 +2098,155 @@ def publish_launchpad(version):
 			release_notes=version.release_notes,
 			changelog=version.changelog,
 			date_released=datetime.today())
+		index.add('releases', version.milestone, release)
 		milestone.is_active = False
 		print("Release %s created" % version.milestone)
 
 	assert release is not None
 
 	# Upload release files.
-	jar_url = lp_upload_file(
-		version,
-		release,
-		version.jar_file(),
-		'Core Library',
-		'application/java-archive',
-		'installer')
-	assert jar_url
-	print(jar_url)
-	tarball_url = lp_upload_file(
-		version,
-		release,
-		version.tar_file(),
-		'Source Code',
-		'application/x-tar',
-		'tarball')
-	assert tarball_url
-	print(tarball_url)
-	zip_url = lp_upload_file(
-		version,
-		release,
-		version.zip_file(),
-		'Binaries',
-		'application/zip',
-		'installer')
-	assert zip_url
-	print(zip_url)
-	dmg_url = lp_upload_file(
-		version,
-		release,
-		version.dmg_file(),
-		'Mac Bundle',
-		'application/octet-stream',
-		'installer')
-	assert dmg_url
-	print(dmg_url)
-	exe_url = lp_upload_file(
-		version,
-		release,
-		version.exe_file(),
-		'Windows Installer',
-		'application/octet-stream',
-		'installer')
-	assert exe_url
-	print(exe_url)
+	uploads = [
+		(version.jar_file(), 'Core Library', 'application/java-archive', 'installer'),
+		(version.tar_file(), 'Source Code', 'application/x-tar', 'tarball'),
+		(version.zip_file(), 'Binaries', 'application/zip', 'installer'),
+		(version.dmg_file(), 'Mac Bundle', 'application/octet-stream', 'installer'),
+		(version.exe_file(), 'Windows Installer', 'application/octet-stream', 'installer'),
+	]
+	# The checksum manifest is only published if it was signed for the
+	# artifacts of this version.
+	if sorted(read_checksums().keys()) == sorted(version.artifacts()) \
+			and path.exists('build/%s.sig' % CHECKSUMS_FILE):
+		uploads.append((CHECKSUMS_FILE, 'SHA-256 Checksums', 'text/plain', 'readme'))
+	lp_upload_files(launchpad, release, lp_pending_uploads(version, release, uploads, server))
+	jar_url = lp_download_url(version, version.jar_file(), server)
+	exe_url = lp_download_url(version, version.exe_file(), server)
+	dmg_url = lp_download_url(version, version.dmg_file(), server)
+	zip_url = lp_download_url(version, version.zip_file(), server)
+	for url in [jar_url, lp_download_url(version, version.tar_file(), server),
+			zip_url, dmg_url, exe_url]:
+		print(url)
 	return (is_new_release, exe_url, dmg_url, zip_url, jar_url)
 
+"Size and SHA-256 digest of a stream, computed as the data is written."
+class StreamDigest:
+	def __init__(self):
+		self.sha256 = hashlib.sha256()
+		self.size = 0
+
+	def write(self, data):
+		self.sha256.update(data)
+		self.size += len(data)
+
+"""A published file to verify: a label naming the remote object, a fetch
+function that streams the remote content to a writer and returns False if
+the object is missing, and the local file it must be identical to."""
+class PublishedObject:
+	def __init__(self, label, fetch, local_path):
+		self.label = label
+		self.fetch = fetch
+		self.local_path = local_path
+
+	# Downloads the object and returns None if it matches the local file,
+	# otherwise a description of the problem.
+	def verify(self):
+		expected = file_checksum(self.local_path)
+		digest = StreamDigest()
+		if not self.fetch(digest.write):
+			return 'missing'
+		if digest.size != expected.size:
+			return 'size %d, expected %d' % (digest.size, expected.size)
+		if digest.sha256.hexdigest() != expected.sha256:
+			return 'SHA-256 %s, expected %s' % (digest.sha256.hexdigest(), expected.sha256)
+		return None
+
+# Returns a fetch function for a URL.
+def http_fetch(url):
+	def fetch(write):
+		try:
+			response = urllib2.urlopen(url)
+		except urllib2.HTTPError as e:
+			if e.code == 404:
+				return False
+			raise
+		try:
+			while True:
+				chunk = response.read(UPLOAD_CHUNK_SIZE)
+				if not chunk:
+					break
+				write(chunk)
+		finally:
+			response.close()
+		return True
+	return fetch
+
+# Returns a fetch function for a file on the update site. Each fetch uses a
+# connection of its own, so that the files are downloaded in parallel.
+def ftp_fetch(dirname, remotename):
+	def fetch(write):
+		shared = get_ftp_session()
+		session = FtpSession(shared.host, shared.port, shared.blocksize)
+		try:
+			session.cwd(dirname)
+			return session.fetch(remotename, write)
+		finally:
+			session.close()
+	return fetch
+
+# Returns the published objects of a version: the release files and their
+# signatures on the given Launchpad server, and the launcher, the manifest,
+# the core library and its delta patches on the update site. Launchpad is
+# skipped if lp_server is None.
+def published_objects(version, lp_server=None, manifest=None):
+	objects = []
+	if lp_server:
+		names = version.artifacts()
+		if sorted(read_checksums().keys()) == sorted(names) \
+				and path.exists('build/%s.sig' % CHECKSUMS_FILE):
+			names = names + [CHECKSUMS_FILE]
+		for name in names:
+			for filename in [name, name + '.sig']:
+				url = lp_download_url(version, filename, lp_server)
+				objects.append(PublishedObject(url, http_fetch(url), 'build/' + filename))
+	if manifest:
+		site = version.updatesite
+		lib = site + '/lib'
+		objects.append(PublishedObject('ftp:%s/ChunkyLauncher.jar' % site,
+				ftp_fetch(site, 'ChunkyLauncher.jar'), 'build/ChunkyLauncher.jar'))
+		objects.append(PublishedObject('ftp:%s/%s' % (site, manifest),
+				ftp_fetch(site, manifest), manifest))
+		objects.append(PublishedObject('ftp:%s/%s' % (lib, version.jar_file()),
+				ftp_fetch(lib, version.jar_file()), 'build/' + version.jar_file()))
+		with open(manifest, 'r') as f:
+			libs = json.load(f)['libraries']
+		for entry in libs:
+			if entry['name'] == version.jar_file():
+				for patch in entry.get('patches', []):
+					objects.append(PublishedObject('ftp:%s/%s' % (lib, patch['name']),
+							ftp_fetch(lib, patch['name']),
+							path.join('build', 'patches', patch['name'])))
+	return objects
+
+# Downloads every published object of a version at the same time, hashing
+# the downloads as they arrive, and compares them with the local files that
+# were signed and uploaded. Exits with an error naming every object that is
+# missing, corrupt or could not be downloaded.
+def verify_published(version, lp_server=None, manifest=None, workers=VERIFY_WORKERS):
+	objects = published_objects(version, lp_server, manifest)
+	print("Verifying %d published files..." % len(objects))
+	failed = []
+	for (obj, problem, error) in parallel_map(lambda obj: obj.verify(), objects, workers):
+		if error:
+			problem = 'download failed: %s' % error[1]
+		if problem:
+			failed.append((obj.label, problem))
+	if failed:
+		print("")
+		print("ERROR: PUBLISHED FILES DO NOT MATCH THE RELEASE BUILD!")
+		for (label, problem) in failed:
+			print("    %s: %s" % (label, problem))
+		sys.exit(1)
+	print("Verified %d published files." % len(objects))
+
 "Output markdown release notes."
 def write_release_notes(version, exe_url, dmg_url, zip_url):
 	text = '''## Downloads
@@ -563,6 +2273,41 @@ exe.dl.link=%s
 dmg.dl.link=%s
 zip.dl.link=%s''' % (version.milestone, exe_url, dmg_url, zip_url))
 
+# Regenerates the release notes and version properties of every version in
+# the ChangeLog, in parallel. Versions whose ChangeLog section is unchanged
+# since the last run, and whose output still exists, are skipped.
+def write_all_release_notes(changelog_path='ChangeLog.txt', workers=BUILD_WORKERS):
+	changelog = ChangeLog(changelog_path)
+	index_path = 'build/release_notes-index.json'
+	previous = {}
+	if path.exists(index_path):
+		with open(index_path, 'r') as f:
+			previous = json.load(f)
+	digests = {}
+	for name in changelog.versions():
+		digests[name] = hashlib.sha256(changelog.section(name).encode('utf-8')).hexdigest()
+	changed = [name for name in changelog.versions() if previous.get(name) != digests[name]
+			or not path.exists('build/release_notes-%s.md' % name)]
+	def regenerate(name):
+		version = Version(name, load=False)
+		version.load_changelog(changelog)
+		write_release_notes(version,
+				lp_download_url(version, version.exe_file()),
+				lp_download_url(version, version.dmg_file()),
+				lp_download_url(version, version.zip_file()))
+	if not path.exists('build'):
+		os.makedirs('build')
+	index = dict((name, previous[name]) for name in digests if name in previous)
+	for (name, result, error) in parallel_map(regenerate, changed, workers):
+		if error:
+			print("Error: failed to write release notes for %s:" % name)
+			traceback.print_exception(*error)
+		else:
+			index[name] = digests[name]
+	with open(index_path, 'w') as f:
+		json.dump(index, f)
+	print("Regenerated release notes for %d of %d versions" % (len(changed), len(digests)))
+
 "Set a Reddit submission to be an announcement."
 def set_announcement(post):
 	flair = next(x for x in post.flair.choices()
@@ -607,109 +2352,583 @@ so please make sure to backup your scenes before using it.
 	set_announcement(post)
 	print("Submitted snapshot thread!")
 
-"patch url into latest.json"
-def patch_url(version, url):
-	print("Patching latest.json")
-	j = None
-	with open('latest.json', 'r') as f:
-		j = json.load(f)
+# Finds the local copy of a library listed in the update site manifest.
+def manifest_library(name):
+	for libdir in MANIFEST_LIB_DIRS:
+		filepath = path.join(libdir, name)
+		if path.isfile(filepath):
+			return filepath
+	return None
+
+# Regenerates the size and digests of every library in latest.json from the
+# local jars, and writes the result to the given manifest file. The jars are
+# hashed in parallel, and unchanged jars are not hashed again. If a jar URL
+# is given, it is set as the download URL of the core library. If patches
+# are given, they replace the delta patches listed for the core library.
+def build_manifest(version, manifest='latest.json', jar_url=None, patches=None,
+		workers=SIGN_WORKERS):
+	print("Generating %s" % manifest)
+	try:
+		with open('latest.json', 'r') as f:
+			j = json.load(f)
+	except (IOError, ValueError):
+		j = None
 	if not j:
 		print('Error: could not read latest.json')
 		sys.exit(1)
 	libs = j['libraries']
-	patched = False
-	for lib in libs:
-		if lib['name'] == version.jar_file():
-			lib['url'] = url
-			patched = True
-			break
-	if not patched:
-		print('Error: failed to patch url in latest.json: core lib not found!')
+	if version.jar_file() not in [lib['name'] for lib in libs]:
+		print('Error: failed to update %s: core lib not found!' % manifest)
 		sys.exit(1)
-	with open('latest.json', 'w') as f:
-		json.dump(j, f)
-
-### MAIN
-if __name__ == "__main__":
+	missing = [lib['name'] for lib in libs if not manifest_library(lib['name'])]
+	if missing:
+		print('Error: libraries not found in %s: %s'
+				% (join(MANIFEST_LIB_DIRS, ', '), join(missing, ', ')))
+		sys.exit(1)
+	hashed = parallel_map(lambda lib: file_checksum(manifest_library(lib['name'])),
+			libs, workers)
+	for (lib, checksum, error) in hashed:
+		if error:
+			raise error[0], error[1], error[2]
+		lib['size'] = checksum.size
+		lib['md5'] = checksum.md5
+		lib['sha256'] = checksum.sha256
+		if jar_url and lib['name'] == version.jar_file():
+			lib['url'] = jar_url
+		if patches is not None and lib['name'] == version.jar_file():
+			lib.pop('patches', None)
+			if patches:
+				lib['patches'] = patches
+	write_atomic(manifest, json.dumps(j))
+	save_checksum_cache()
+
+"""Delta patch from one core jar to another. Zip entries are compared record
+by record: the compressed data of an entry that is unchanged in the old jar
+is copied from it, and everything else (the local headers, changed entries
+and the central directory) is stored literally in the patch. Applying a
+patch reproduces the new jar byte for byte.
+
+Patch file format:
+
+	CHUNKYPATCH1\n
+	<JSON header>\n
+	<literal data>
+
+The header lists the copy operations in order, as [source, offset, length]
+triples where source is 0 for the old jar and 1 for the literal data."""
+class JarDelta:
+	MAGIC = 'CHUNKYPATCH1\n'
+
+	def __init__(self, ops=[], literal=''):
+		self.ops = list(ops)
+		self.literal = literal
+
+	def add(self, source, offset, length):
+		if length <= 0:
+			return
+		if self.ops:
+			(last_source, last_offset, last_length) = self.ops[-1]
+			if last_source == source and last_offset + last_length == offset:
+				self.ops[-1] = [source, last_offset, last_length + length]
+				return
+		self.ops.append([source, offset, length])
+
+	# Returns {name: (data offset, compressed size, crc, compression)} for
+	# the entries of a jar.
+	@staticmethod
+	def entries(jar, f):
+		result = {}
+		for info in jar.infolist():
+			f.seek(info.header_offset)
+			header = f.read(30)
+			(name_len, extra_len) = struct.unpack('<HH', header[26:30])
+			start = info.header_offset + 30 + name_len + extra_len
+			result[info.filename] = (start, info.compress_size, info.CRC, info.compress_type)
+		return result
+
+	@staticmethod
+	def diff(old_path, new_path):
+		delta = JarDelta()
+		literal = io.BytesIO()
+		with open(old_path, 'rb') as old_file, open(new_path, 'rb') as new_file:
+			old_entries = JarDelta.entries(zipfile.ZipFile(old_file), old_file)
+			new_entries = JarDelta.entries(zipfile.ZipFile(new_file), new_file)
+			pos = 0
+			for (name, (start, size, crc, method)) in sorted(new_entries.items(),
+					key=lambda item: item[1][0]):
+				old = old_entries.get(name)
+				if not old or old[1:] != (size, crc, method) or size == 0:
+					continue
+				old_file.seek(old[0])
+				new_file.seek(start)
+				if old_file.read(size) != new_file.read(size):
+					continue
+				new_file.seek(pos)
+				delta.add(1, literal.tell(), start - pos)
+				literal.write(new_file.read(start - pos))
+				delta.add(0, old[0], size)
+				pos = start + size
+			new_file.seek(pos)
+			rest = new_file.read()
+			delta.add(1, literal.tell(), len(rest))
+			literal.write(rest)
+		delta.literal = literal.getvalue()
+		return delta
+
+	def write(self, filepath, header):
+		header = dict(header, ops=self.ops)
+		write_atomic(filepath, self.MAGIC + json.dumps(header) + '\n' + self.literal)
+
+	# Rebuilds the new jar from the old jar and a patch file.
+	@staticmethod
+	def apply(old_path, patch_path, new_path):
+		with open(patch_path, 'rb') as f:
+			if f.read(len(JarDelta.MAGIC)) != JarDelta.MAGIC:
+				raise ValueError('%s is not a jar patch' % patch_path)
+			header = json.loads(f.readline())
+			literal = f.read()
+		with open(old_path, 'rb') as old_file, open(new_path, 'wb') as out:
+			for (source, offset, length) in header['ops']:
+				if source == 0:
+					old_file.seek(offset)
+					out.write(old_file.read(length))
+				else:
+					out.write(literal[offset:offset + length])
+		return header
+
+# Returns the directory of the published core jars of an update site.
+def published_jars_dir(version):
+	return path.join(PUBLISHED_JARS_DIR, version.updatesite)
+
+# Keeps a copy of the published core jar, and removes the older jars that
+# are no longer used for patches.
+def remember_published_jar(version):
+	jar_dir = published_jars_dir(version)
+	if not path.isdir(jar_dir):
+		os.makedirs(jar_dir)
+	copy_path('build/' + version.jar_file(), path.join(jar_dir, version.jar_file()))
+	jars = sorted(os.listdir(jar_dir), key=lambda name: path.getmtime(path.join(jar_dir, name)))
+	for name in jars[:-DELTA_HISTORY]:
+		os.remove(path.join(jar_dir, name))
+
+# Returns the paths of the core jars last published to the update site,
+# newest first. In a fresh checkout, the core jar of the currently published
+# manifest is downloaded from the update site.
+def previous_core_jars(version, session, manifest):
+	jar_dir = published_jars_dir(version)
+	if not path.isdir(jar_dir):
+		os.makedirs(jar_dir)
+	if not os.listdir(jar_dir) and manifest:
+		session.cwd(version.updatesite)
+		try:
+			remote = json.loads(session.read(manifest) or 'null')
+		except ValueError:
+			remote = None
+		names = [lib['name'] for lib in (remote or {}).get('libraries', [])
+				if lib['name'].startswith('chunky-core-')]
+		if names and names[0] != version.jar_file():
+			print("Downloading %s for delta patches" % names[0])
+			session.cwd(version.updatesite + '/lib')
+			session.download(names[0], path.join(jar_dir, names[0]))
+	jars = [path.join(jar_dir, name) for name in os.listdir(jar_dir)
+			if name != version.jar_file() and not name.endswith('.part')]
+	jars.sort(key=path.getmtime, reverse=True)
+	return jars[:DELTA_HISTORY]
+
+# Makes delta patches from the previously published core jars to the new
+# core jar, in build/patches/. Each patch is checked by applying it. Returns
+# the manifest entries of the patches that are small enough to be worth it.
+def make_core_patches(version, session, manifest):
+	jar = 'build/' + version.jar_file()
+	target = file_checksum(jar)
+	patch_dir = path.join('build', 'patches')
+	if not path.isdir(patch_dir):
+		os.makedirs(patch_dir)
+	def make_patch(old_jar):
+		old_name = path.basename(old_jar)
+		name = '%s.from-%s.patch' % (version.jar_file(), old_name[len('chunky-core-'):-len('.jar')])
+		patch_path = path.join(patch_dir, name)
+		source = file_checksum(old_jar)
+		with profiler.span('delta ' + name, 'delta'):
+			JarDelta.diff(old_jar, jar).write(patch_path, {
+				'source': old_name, 'source_sha256': source.sha256,
+				'target': version.jar_file(), 'target_sha256': target.sha256})
+			JarDelta.apply(old_jar, patch_path, patch_path + '.check')
+			ok = file_checksum(patch_path + '.check').sha256 == target.sha256
+			os.remove(patch_path + '.check')
+		if not ok:
+			raise ValueError('patch %s does not reproduce %s' % (name, version.jar_file()))
+		checksum = file_checksum(patch_path)
+		print("Delta patch %s: %d bytes (%.0f%% of the jar)"
+				% (name, checksum.size, 100.0 * checksum.size / max(target.size, 1)))
+		if checksum.size > DELTA_MAX_RATIO * target.size:
+			return None
+		return {'name': name, 'from': old_name, 'from_sha256': source.sha256,
+				'size': checksum.size, 'md5': checksum.md5, 'sha256': checksum.sha256}
+	patches = []
+	for (old_jar, patch, error) in parallel_map(make_patch,
+			previous_core_jars(version, session, manifest), SIGN_WORKERS):
+		if error:
+			print("Warning: no delta patch from %s:" % path.basename(old_jar))
+			traceback.print_exception(*error)
+		elif patch:
+			patches.append(patch)
+	return patches
+
+def print_usage():
+	print("usage: SHIPIT [COMMAND] [VERSION]")
+	print("commands:")
+	print("    -ftp         upload latest.json to FTP server")
+	print("    -docs        update documentation")
+	print("    -snapshot    build snapshot instead of release")
+	print("    -launcher    upload the launcher to the FTP server")
+	print("    -nocache     rebuild all release stages, ignoring the stage cache")
+	print("    -allnotes    regenerate release notes for every version in the ChangeLog")
+	print("    -plan=FILE   answer prompts from a JSON release plan, unattended")
+	print("    -KEY=ANSWER  answer a prompt, where KEY is one of:")
+	for key in sorted(PLAN_KEYS.keys()):
+		print("                     %-11s %s" % (key, PLAN_KEYS[key]))
+	print("    -unattended  give the default answer to prompts not in the plan")
+	print("    -serve       run the release daemon, accepting jobs on %s" % DAEMON_SOCKET)
+	print("    -verify      check the published files of a version against the local build")
+	print("    -history     show the durations of past builds and flag regressions")
+	print("    -threshold=PCT  slowdown against the baseline reported as a regression")
+	print("                 (default %d%%)" % (REGRESSION_THRESHOLD * 100))
+	print("    -watch       publish a snapshot whenever the branch changes, numbering")
+	print("                 snapshots from the given version, e.g. 2.4.0-snapshot")
+	print("")
+	print("Several versions can be released at once with VERSION@BRANCH arguments,")
+	print("e.g. 1.4.6@master 2.0.1@flattening. Each is built in its own worktree.")
+	print("    -submit ...  run the rest of the command line as a job in the daemon")
+	print("")
+	print("This utility creates a new release of Chunky")
+	print("Required Python libraries: launchpadlib, PRAW")
+	print("Upgrade with >pip install --upgrade <PKG>")
+
+# Parses command line arguments into (options, version). Prompt answers are
+# added to the release plan.
+def parse_args(argv):
 	version = None
 	options = {
 		'ftp': False,
 		'docs': False,
 		'snapshot': False,
 		'prawdebug': False,
-		'launcher': False
+		'launcher': False,
+		'nocache': False,
+		'allnotes': False,
+		'serve': False,
+		'watch': False,
+		'history': False,
+		'verify': False,
+		'threshold': REGRESSION_THRESHOLD,
+		'targets': []
 	}
-	for arg in sys.argv[1:]:
+	for arg in argv:
 		if arg == '-h' or arg == '--h' or arg == '-help' or arg == '--help':
-			print("usage: SHIPIT [COMMAND] [VERSION]")
-			print("commands:")
-			print("    -ftp         upload latest.json to FTP server")
-			print("    -docs        update documentation")
-			print("    -snapshot    build snapshot instead of release")
-			print("    -launcher    upload the launcher to the FTP server")
-			print("")
-			print("This utility creates a new release of Chunky")
-			print("Required Python libraries: launchpadlib, PRAW")
-			print("Upgrade with >pip install --upgrade <PKG>")
+			print_usage()
 			sys.exit(0)
 		else:
-			if arg.startswith('-'):
+			if arg.startswith('-plan='):
+				loaded = ReleasePlan.load(arg[len('-plan='):])
+				plan.answers.update(loaded.answers)
+				plan.unattended = plan.unattended or loaded.unattended
+			elif arg.startswith('-threshold='):
+				options['threshold'] = float(arg[len('-threshold='):]) / 100
+			elif arg == '-unattended':
+				plan.unattended = True
+			elif arg.startswith('-') and '=' in arg and arg[1:arg.index('=')] in PLAN_KEYS:
+				plan.answers[arg[1:arg.index('=')]] = arg[arg.index('=') + 1:]
+			elif arg.startswith('-'):
 				matched = False
 				for key in options.keys():
-					if arg == '-'+key:
+					if isinstance(options[key], bool) and arg == '-'+key:
 						options[key] = True
 						matched = True
 						break
 				if not matched:
 					print("Error: unknown command: %s" % arg)
 					sys.exit(1)
+			elif '@' in arg:
+				(name, _, branch) = arg.partition('@')
+				options['targets'].append((Version(name, load=False), branch))
 			elif version is None:
 				version = Version(arg)
 			else:
 				print("Error: redundant argument: %s" % arg)
 				sys.exit(1)
+	return (options, version)
+
+# Runs the command selected by the options.
+def run_command(options, version):
+	if options['prawdebug']:
+		r = reddit_login()
+		post = r.subreddit('chunky').submit('Test post',
+				selftext='Debugging the reddit bot.')
+		print(post.flair.choices())
+		set_announcement(post)
+		return
 
-	try:
-		credentials = Credentials(path.join('private', 'credentials.gpg'))
-
-		if options['prawdebug']:
-			r = reddit_login()
-			post = r.subreddit('chunky').submit('Test post',
-					selftext='Debugging the reddit bot.')
-			print(post.flair.choices())
-			set_announcement(post)
-			sys.exit(0)
+	if options['launcher']:
+		publish_launcher(version)
+		return
 
-		if options['launcher']:
-			publish_launcher(version)
-			sys.exit(0)
+	if options['allnotes']:
+		write_all_release_notes()
+		return
+
+	if options['history']:
+		history_report(options['threshold'])
+		return
+
+	if options['targets']:
+		if version:
+			print("Error: give either one version or VERSION@BRANCH targets")
+			sys.exit(1)
+		release_matrix(options['targets'])
+		return
 
-		if version == None:
-			version = Version(raw_input('Enter version: '))
+	if version == None:
+		version = Version(ask('version', 'Enter version: '))
 
-		if options['ftp']:
-			publish_ftp(version)
-		elif options['docs']:
-			update_docs(version)
-		elif options['snapshot']:
+	if options['watch']:
+		watch_snapshots(version)
+	elif options['verify']:
+		verify_published(version,
+				manifest='snapshot.json' if version.suffix else 'latest.json',
+				lp_server=None if version.suffix else ask_lp_server())
+	elif options['ftp']:
+		publish_ftp(version)
+	elif options['docs']:
+		update_docs(version)
+	elif options['snapshot']:
+		with recorded_run('snapshot', version):
 			build_snapshot(version)
+	else:
+		with recorded_run('release', version):
+			build_release(version, use_cache=not options['nocache'])
+		if ask('push', 'Push git release commit? [y/N] ') == "y":
+			gh_user = credentials.get('github user')
+			gh_token = credentials.getpass('github token')
+			main_repo = 'github.com/llbit/chunky.git'
+			branch = os.environ.get('RELEASE_GIT_BRANCH', 'master')
+			check_call('git',
+					['git', 'push', 'https://%s:%s@%s' % (gh_user, gh_token, main_repo),
+						'HEAD:refs/heads/' + branch])
+			check_call('git',
+					['git', 'push', 'https://%s:%s@%s' % (gh_user, gh_token, main_repo), version.full])
+		print("All done.")
+
+# Creates or updates the worktree of a release matrix target, checked out
+# at the head of its branch. The files of the release directory that are not
+# in the Chunky repository are linked into the worktree.
+def prepare_worktree(version, branch):
+	worktree = path.join(WORKTREE_DIR, version.full)
+	ref = 'origin/' + branch
+	if traced_call(['git', 'rev-parse', '--verify', '-q', ref], stdout=PIPE)[0] != 0:
+		ref = branch
+	if path.exists(path.join(worktree, '.git')):
+		with cd(worktree):
+			check_call('git', ['git', 'checkout', '-q', '--detach', ref])
+	else:
+		check_call('git', ['git', 'worktree', 'add', '--detach', worktree, ref])
+	release_dir = os.getcwd()
+	shared = WORKTREE_SHARED + [name for name in os.listdir('.')
+			if name.startswith('release_notes-') and name.endswith('.txt')]
+	for name in shared:
+		link = path.join(worktree, name)
+		if path.exists(name) and not path.lexists(link):
+			os.symlink(path.join(release_dir, name), link)
+	return worktree
+
+# Runs the release or snapshot of one matrix target in a child process, with
+# its output prefixed by the version. Returns the exit status.
+def run_matrix_target(version, branch, worktree, secrets):
+	command = [sys.executable, path.abspath(__file__), '-credentials=-', '-unattended']
+	command += ['-%s=%s' % (key, value) for (key, value) in sorted(plan.answers.items())
+			if key in PLAN_KEYS]
+	if version.suffix:
+		command.append('-snapshot')
+	command.append(version.full)
+	env = dict(os.environ, RELEASE_GIT_BRANCH=branch)
+	with profiler.span(version.full, 'matrix', branch=branch):
+		child = Popen(command, cwd=worktree, env=env, stdin=PIPE, stdout=PIPE,
+				stderr=STDOUT)
+		child.stdin.write(secrets)
+		child.stdin.close()
+		for line in iter(child.stdout.readline, ''):
+			sys.stdout.write('[%s] %s' % (version.full, line))
+			sys.stdout.flush()
+		return child.wait()
+
+# Releases several versions at the same time, each from its own branch in a
+# separate git worktree. The worktrees share the Gradle cache in the user
+# home. Every target runs unattended with the answers of the release plan,
+# so the credentials and logins are set up before the targets start.
+def release_matrix(targets):
+	for (version, branch) in targets:
+		print("Target %s from %s (@%s)" % (version.full, branch, version.updatesite))
+	# The answers are passed on to the targets, which cannot prompt.
+	def ask_targets(key, prompt):
+		plan.answers[key] = ask(key, prompt)
+		return plan.answers[key]
+	if ask_targets('build', 'Build all targets? [y/N] ') == 'y':
+		unlock_signing_key()
+	if ask_targets('launchpad', 'Publish to Launchpad? [y/N] ') == 'y':
+		(launchpad, server) = lp_login()
+		plan.answers['production'] = 'y' if server == 'production' else 'n'
+	if ask_targets('ftp', 'Publish to FTP? [y/N] ') == 'y':
+		credentials.get('ftp user')
+		credentials.getpass('ftp password')
+	if ask_targets('reddit', 'Post release threads? [y/N] ') == 'y':
+		reddit_login()
+	docs = ask_targets('docs', 'Update documentation? [y/N] ')
+	if ask_targets('push', 'Push git release commits? [y/N] ') == 'y' or docs == 'y':
+		credentials.get('github user')
+		credentials.getpass('github token')
+	if 'y' not in [plan.answers[key] for key in
+			['build', 'launchpad', 'ftp', 'reddit', 'docs', 'push']]:
+		print("Error: nothing to build or publish for the release matrix")
+		sys.exit(1)
+	credentials.flush()
+	secrets = json.dumps(credentials.credentials)
+	check_call('git', ['git', 'fetch', 'origin'])
+	worktrees = [prepare_worktree(version, branch) for (version, branch) in targets]
+	start = time.time()
+	results = parallel_map(lambda item:
+			run_matrix_target(item[0][0], item[0][1], item[1], secrets),
+			zip(targets, worktrees), len(targets))
+	print("")
+	print("Release matrix (%.1f s):" % (time.time() - start))
+	failed = False
+	for (((version, branch), worktree), status, error) in results:
+		if error:
+			traceback.print_exception(*error)
+		ok = not error and status == 0
+		failed = failed or not ok
+		print("    %-16s %-16s %-14s %s" % (version.full, branch, version.updatesite,
+				'done' if ok else 'failed'))
+	if failed:
+		sys.exit(1)
+
+"""Long-running release server. Jobs are shipit command lines sent over a
+Unix socket by -submit. They run one at a time in this process, so the
+Launchpad, Reddit and FTP logins, the unlocked gpg key and the Gradle daemon
+stay warm between jobs. The output of a job is sent back to the client.
+Jobs run unattended: prompts not answered by the job get their default."""
+def serve(socket_path=DAEMON_SOCKET):
+	if path.exists(socket_path):
+		os.remove(socket_path)
+	with open(os.devnull, 'w') as devnull:
+		traced_call(['gpg-connect-agent', '/bye'], stdout=devnull, stderr=devnull)
+	if path.exists('gradlew'):
+		# Starts the Gradle daemon in the background.
+		def warmup():
+			with open(os.devnull, 'w') as devnull:
+				traced_call(['./gradlew', '--daemon', 'help'], stdout=devnull, stderr=STDOUT)
+		Future(warmup)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(socket_path)
+	server.listen(5)
+	print("Release daemon listening on %s" % socket_path)
+	try:
+		while True:
+			(conn, address) = server.accept()
+			try:
+				run_job(conn)
+			finally:
+				conn.close()
+	finally:
+		server.close()
+		os.remove(socket_path)
+
+# Runs one job from a client connection, with the standard output and
+# error of this process (and its subprocesses) redirected to the client.
+def run_job(conn):
+	global plan
+	argv = json.loads(conn.makefile('rb').readline())
+	print("Running job: %s" % join(argv, ' '))
+	sys.stdout.flush()
+	sys.stderr.flush()
+	saved = (os.dup(1), os.dup(2))
+	os.dup2(conn.fileno(), 1)
+	os.dup2(conn.fileno(), 2)
+	status = 0
+	try:
+		plan = ReleasePlan(unattended=True)
+		(options, version) = parse_args(argv)
+		run_command(options, version)
+		credentials.flush()
+	except SystemExit as e:
+		status = e.code if isinstance(e.code, int) else int(e.code is not None)
+	except:
+		traceback.print_exc()
+		status = 1
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		os.dup2(saved[0], 1)
+		os.dup2(saved[1], 2)
+		os.close(saved[0])
+		os.close(saved[1])
+	try:
+		conn.sendall('\0%d\n' % status)
+	except socket.error:
+		pass
+	print("Job finished with status %d" % status)
+
+# Sends a job to the release daemon and prints its output. Returns the exit
+# status of the job.
+def submit_job(argv, socket_path=DAEMON_SOCKET):
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.connect(socket_path)
+	client.sendall(json.dumps(argv) + '\n')
+	trailer = None
+	while True:
+		data = client.recv(1 << 16)
+		if not data:
+			break
+		if trailer is not None:
+			trailer += data
+		elif '\0' in data:
+			(output, _, trailer) = data.partition('\0')
+			sys.stdout.write(output)
+		else:
+			sys.stdout.write(data)
+		sys.stdout.flush()
+	client.close()
+	if not trailer or not trailer.strip().isdigit():
+		print("Error: lost connection to the release daemon")
+		return 1
+	return int(trailer.strip())
+
+### MAIN
+if __name__ == "__main__":
+	if sys.argv[1:2] == ['-submit']:
+		sys.exit(submit_job(sys.argv[2:]))
+
+	argv = sys.argv[1:]
+	backend = GpgBackend(path.join('private', 'credentials.gpg'))
+	if '-credentials=-' in argv:
+		argv.remove('-credentials=-')
+		backend = PipeBackend(sys.stdin)
+
+	(options, version) = parse_args(argv)
+
+	try:
+		credentials = Credentials(backend)
+		atexit.register(credentials.flush)
+		atexit.register(profiler.save)
+		atexit.register(save_checksum_cache)
+
+		if options['serve']:
+			serve()
 		else:
-			build_release(version)
-			if raw_input('Push git release commit? [y/N] ') == "y":
-				gh_user = credentials.get('github user')
-				gh_token = credentials.getpass('github token')
-				main_repo = 'github.com/llbit/chunky.git'
-				check_call('git',
-						['git', 'push', 'https://%s:%s@%s' % (gh_user, gh_token, main_repo), 'master'])
-				check_call('git',
-						['git', 'push', 'https://%s:%s@%s' % (gh_user, gh_token, main_repo), version.full])
-			print("All done.")
+			run_command(options, version)
 	except SystemExit:
 		raise
 	except:
 		exc_type, exc_value, exc_traceback = sys.exc_info()
 		print("Unexpected error:")
 		traceback.print_exception(exc_type, exc_value, exc_traceback)
-		print("Release aborted. Press enter to exit.")
-		raw_input()
-
+		ask('continue', "Release aborted. Press enter to exit.")